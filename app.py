@@ -1,23 +1,52 @@
 import os, sys
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort, stream_with_context
 from sqlalchemy import exc
 import json
 from flask_cors import CORS
 
 from database.models import setup_db, Movie, Actor
-from auth.auth import AuthError, requires_auth
+from database.graph import graph, GRAPH_MAX_DEPTH
+from database.queries import find_movie, find_actor, all_movies, all_actors
+from database.cache import setup_entity_cache
+from database.counts import total_count_header, COUNT_MODES
+from database.stats import movies_per_year, actor_age_by_gender, largest_casts
+from database.jobs import JOB_KINDS, enqueue, required_permission
+from database.models import Job
+from database.changes import feed, stream_changes, CHANGE_FEED_POLL_TIMEOUT
+from auth.auth import AuthError, requires_auth, get_current_user, check_permissions
+from middleware.idempotency import setup_idempotency, idempotent
+from middleware.coalesce import setup_coalescing, coalesced
+from middleware.ratelimit import setup_rate_limiting, rate_limited, admission_exempt
+from middleware.compression import setup_compression
+from middleware.dbguard import setup_db_guard, CircuitOpen, QueryBudgetExceeded, is_query_timeout
+
+
+'''
+    Retry-After header of a 429 or 503 error, if the error carries one
+'''
+def retry_after(error):
+    if getattr(error, 'retry_after', None):
+        return {'Retry-After': str(error.retry_after)}
+    return {}
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
+    setup_db_guard(app)
+    setup_entity_cache(app)
+    setup_idempotency(app)
+    setup_coalescing(app)
+    setup_rate_limiting(app)
+    setup_compression(app)
 
     CORS(app, resources={ r'/*': {'origins': '*'}}, supports_credentials=True)
 
     @app.after_request
     def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, Idempotency-Key')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+        response.headers.add('Access-Control-Expose-Headers', 'X-Total-Count')
         return response
 
     ## ROUTES
@@ -25,11 +54,19 @@ def create_app(test_config=None):
         GET /movies
         returns status code 200 and json {"success": True, "movies": movies} where movies is the list of movies
             or appropriate status code indicating reason for failure
+        concurrent identical requests share a single query and response
+        ?count=exact|estimated adds the total number of movies in the X-Total-Count header
     '''
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @rate_limited
+    @coalesced
     def get_movies():
-        movies = Movie.query.all()
+        count = request.args.get('count', 'none')
+        if count not in COUNT_MODES:
+            abort(400)
+
+        movies = all_movies()
         if movies is None:
             abort(404)
 
@@ -38,15 +75,18 @@ def create_app(test_config=None):
         return jsonify({
             "success": True,
             "movies": movies_list
-        })
+        }), 200, total_count_header(Movie, count)
 
     '''
         POST /movies
         returns status code 200 and json {"success": True, "movies": movie} where movie an array containing only the newly created movie
             or appropriate status code indicating reason for failure
+        an optional Idempotency-Key header makes retries replay the first response instead of creating another movie
     '''
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @rate_limited
+    @idempotent
     def add_movie():
         body = request.get_json()
         title = body.get('title')
@@ -60,12 +100,30 @@ def create_app(test_config=None):
                 "created": movie.id,
                 "movies": [movie.format()]
             })
-        except Exception as e:
-            error = True
+        except (exc.IntegrityError, exc.DataError) as e:
             print(sys.exc_info())
             print(e)
             abort(422)
 
+    '''
+        GET /movies/<id>
+        returns status code 200 and json {"success": True, "movies": movie} where movie an array containing only the requested movie
+            or appropriate status code indicating reason for failure
+        served from the entity cache when possible, the X-Cache header tells whether it was a HIT or a MISS
+    '''
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @rate_limited
+    def get_movie(movie_id):
+        movie, cached = app.extensions['entity_cache'].get(Movie, movie_id, find_movie)
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "movies": [movie]
+        }), 200, {'X-Cache': 'HIT' if cached else 'MISS'}
+
     '''
         PATCH /movies/<id>
         returns status code 200 and json {"success": True, "movies": movie} where movie an array containing only the updated movie
@@ -73,12 +131,13 @@ def create_app(test_config=None):
     '''
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @rate_limited
     def update_movie(movie_id):
         body = request.get_json()
         title = body.get('title')
         release_date = body.get('release_date', [])
 
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        movie = find_movie(movie_id)
         
         if movie is None:
             abort(404)
@@ -93,8 +152,7 @@ def create_app(test_config=None):
                 "movies": [movie.format()]
             })
 
-        except Exception as e:
-            error = True
+        except (exc.IntegrityError, exc.DataError) as e:
             print(sys.exc_info())
             print(e)
             abort(422)
@@ -106,8 +164,9 @@ def create_app(test_config=None):
     '''
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
+    @rate_limited
     def delete_movie(movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        movie = find_movie(movie_id)
         
         if movie is None:
             abort(404)
@@ -120,8 +179,7 @@ def create_app(test_config=None):
                 "delete": movie.id
             })
 
-        except Exception as e:
-            error = True
+        except (exc.IntegrityError, exc.DataError) as e:
             print(sys.exc_info())
             print(e)
             abort(422)
@@ -132,12 +190,20 @@ def create_app(test_config=None):
         GET /actors
         returns status code 200 and json {"success": True, "actors": actors} where actors is the list of actors
             or appropriate status code indicating reason for failure
+        concurrent identical requests share a single query and response
+        ?count=exact|estimated adds the total number of actors in the X-Total-Count header
     '''
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @rate_limited
+    @coalesced
     def get_actors():
-        actors = Actor.query.all()
+        count = request.args.get('count', 'none')
+        if count not in COUNT_MODES:
+            abort(400)
+
+        actors = all_actors()
         if actors is None:
             abort(404)
 
@@ -146,15 +212,18 @@ def create_app(test_config=None):
         return jsonify({
             "success": True,
             "actors": actors_list
-        })
+        }), 200, total_count_header(Actor, count)
 
     '''
         POST /actors
         returns status code 200 and json {"success": True, "actors": actor} where actor an array containing only the newly created actor
             or appropriate status code indicating reason for failure
+        an optional Idempotency-Key header makes retries replay the first response instead of creating another actor
     '''
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @rate_limited
+    @idempotent
     def add_actor():
         body = request.get_json()
         name = body.get('name')
@@ -169,12 +238,30 @@ def create_app(test_config=None):
                 "created": actor.id,
                 "actors": [actor.format()]
             })
-        except Exception as e:
-            error = True
+        except (exc.IntegrityError, exc.DataError) as e:
             print(sys.exc_info())
             print(e)
             abort(422)
 
+    '''
+        GET /actors/<id>
+        returns status code 200 and json {"success": True, "actors": actor} where actor an array containing only the requested actor
+            or appropriate status code indicating reason for failure
+        served from the entity cache when possible, the X-Cache header tells whether it was a HIT or a MISS
+    '''
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @rate_limited
+    def get_actor(actor_id):
+        actor, cached = app.extensions['entity_cache'].get(Actor, actor_id, find_actor)
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "actors": [actor]
+        }), 200, {'X-Cache': 'HIT' if cached else 'MISS'}
+
     '''
         PATCH /actors/<id>
         returns status code 200 and json {"success": True, "actors": actor} where actor an array containing only the updated actor
@@ -182,13 +269,14 @@ def create_app(test_config=None):
     '''
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
+    @rate_limited
     def update_actor(actor_id):
         body = request.get_json()
         name = body.get('name')
         age = body.get('age')
         gender = body.get('gender')
 
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        actor = find_actor(actor_id)
         
         if actor is None:
             abort(404)
@@ -204,8 +292,7 @@ def create_app(test_config=None):
                 "actors": [actor.format()]
             })
 
-        except Exception as e:
-            error = True
+        except (exc.IntegrityError, exc.DataError) as e:
             print(sys.exc_info())
             print(e)
             abort(422)
@@ -217,8 +304,9 @@ def create_app(test_config=None):
     '''
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
+    @rate_limited
     def delete_actor(actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        actor = find_actor(actor_id)
         
         if actor is None:
             abort(404)
@@ -231,15 +319,247 @@ def create_app(test_config=None):
                 "delete": actor.id
             })
 
-        except Exception as e:
-            error = true
+        except (exc.IntegrityError, exc.DataError) as e:
             print(sys.exc_info())
             print(e)
             abort(422)
 
 
+    '''
+        GET /actors/<id>/costars
+        returns status code 200 and json {"success": True, "actor": id, "costars": costars} where costars is the list of
+            actors who worked with the actor, each with the number of movies they share, most frequent first
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/actors/<int:actor_id>/costars', methods=['GET'])
+    @requires_auth('get:actors')
+    @rate_limited
+    def get_costars(actor_id):
+        if find_actor(actor_id) is None:
+            abort(404)
+
+        shared = graph.get().costars(actor_id)
+        costars = Actor.query.filter(Actor.id.in_(shared)).all() if shared else []
+        costars_list = [dict(costar.format(), movies_together=shared[costar.id]) for costar in costars]
+        costars_list.sort(key=lambda costar: (-costar['movies_together'], costar['id']))
+
+        return jsonify({
+            "success": True,
+            "actor": actor_id,
+            "costars": costars_list
+        })
+
+    '''
+        GET /actors/<a>/path/<b>?max_depth=<n>
+        returns status code 200 and json {"success": True, "degrees": n, "actors": actors, "movies": movies} where actors
+            is the shortest chain of co-stars from actor a to actor b and movies[i] links actors[i] and actors[i + 1].
+            degrees is null when there is no chain within max_depth hops, truncated tells the depth or time limit was reached
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/actors/<int:source_id>/path/<int:target_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @rate_limited
+    def get_costar_path(source_id, target_id):
+        if Actor.query.filter(Actor.id.in_([source_id, target_id])).count() != len({source_id, target_id}):
+            abort(404)
+
+        max_depth = min(request.args.get('max_depth', GRAPH_MAX_DEPTH, type=int), GRAPH_MAX_DEPTH)
+        for attempt in range(2):
+            actor_ids, movie_ids, truncated = graph.get().path(source_id, target_id, max_depth=max_depth)
+
+            actors = {actor.id: actor for actor in Actor.query.filter(Actor.id.in_(actor_ids))} if actor_ids else {}
+            movies = {movie.id: movie for movie in Movie.query.filter(Movie.id.in_(movie_ids))} if movie_ids else {}
+            if all(id in actors for id in actor_ids) and all(id in movies for id in movie_ids):
+                break
+            # the index of this worker still links records deleted elsewhere, rebuild it and search again
+            graph.invalidate()
+        else:
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "degrees": len(movie_ids) if actor_ids else None,
+            "truncated": truncated,
+            "actors": [actors[id].format() for id in actor_ids],
+            "movies": [movies[id].format() for id in movie_ids]
+        })
+
+    ### Statistics API
+
+    '''
+        GET /stats/movies-per-year
+        returns status code 200 and json {"success": True, "movies_per_year": [{"year": year, "movies": n}]}
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/stats/movies-per-year', methods=['GET'])
+    @requires_auth('get:movies')
+    @rate_limited
+    def get_movies_per_year():
+        return jsonify({
+            "success": True,
+            "movies_per_year": movies_per_year()
+        })
+
+    '''
+        GET /stats/actor-age-by-gender
+        returns status code 200 and json {"success": True, "actor_age_by_gender": [{"gender": gender, "actors": n, "average_age": age}]}
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/stats/actor-age-by-gender', methods=['GET'])
+    @requires_auth('get:actors')
+    @rate_limited
+    def get_actor_age_by_gender():
+        return jsonify({
+            "success": True,
+            "actor_age_by_gender": actor_age_by_gender()
+        })
+
+    '''
+        GET /stats/cast-size?limit=<n>
+        returns status code 200 and json {"success": True, "largest_casts": [{"movie_id": id, "actors": n}]}
+            where largest_casts are the limit (default 10, at most 100) movies with most actors
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/stats/cast-size', methods=['GET'])
+    @requires_auth('get:movies')
+    @rate_limited
+    def get_cast_size():
+        limit = min(max(request.args.get('limit', 10, type=int), 0), 100)
+
+        return jsonify({
+            "success": True,
+            "largest_casts": largest_casts(limit)
+        })
+
+    ### Jobs API
+
+    '''
+        POST /jobs
+        queues a long running operation: {"kind": "import", "entity": "movies", "records": [...]},
+            {"kind": "export", "entity": "actors"}, {"kind": "bulk_delete", "entity": "movies", "ids": [...]}
+            or {"kind": "refresh_stats"}. Each kind needs the permission of the operation it runs.
+        returns status code 202 and json {"success": True, "created": id, "jobs": job} where job an array containing only the queued job
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/jobs', methods=['POST'])
+    @requires_auth('get:movies')
+    @rate_limited
+    @idempotent
+    def add_job():
+        body = request.get_json() or {}
+        kind = body.pop('kind', None)
+        if kind not in JOB_KINDS:
+            abort(422)
+        check_permissions(required_permission(kind, body), get_current_user())
+
+        job = enqueue(kind, body, created_by=get_current_user().get('sub'))
+        return jsonify({
+            "success": True,
+            "created": job.id,
+            "jobs": [job.format()]
+        }), 202
+
+    '''
+        GET /jobs/<id>
+        returns status code 200 and json {"success": True, "jobs": job} where job an array containing only the job
+            with its status (queued, running, succeeded or failed), progress from 0 to 1 and result
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @rate_limited
+    def get_job(job_id):
+        job = Job.query.get(job_id)
+        if job is None or job.created_by != get_current_user().get('sub'):
+            abort(404)
+
+        return jsonify({
+            "success": True,
+            "jobs": [job.format()]
+        })
+
+    ### Changes API
+
+    '''
+        entities of the change log the current user can read
+    '''
+    def readable_entities():
+        permissions = get_current_user().get('permissions', [])
+        return [entity for entity in ('movie', 'actor') if f'get:{entity}s' in permissions]
+
+    '''
+        GET /changes?since=<cursor>&timeout=<seconds>
+        returns status code 200 and json {"success": True, "changes": changes, "cursor": cursor} where changes are the
+            inserts, updates and deletes after the cursor and cursor is the value to pass as since in the next request.
+            If there are no changes yet the request waits up to timeout seconds for one (long polling)
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/changes', methods=['GET'])
+    @admission_exempt
+    @requires_auth('get:movies')
+    @rate_limited
+    def get_changes():
+        since = request.args.get('since', 0, type=int)
+        timeout = request.args.get('timeout', CHANGE_FEED_POLL_TIMEOUT, type=float)
+        timeout = min(max(timeout, 0), CHANGE_FEED_POLL_TIMEOUT)
+
+        changes = feed.wait(since, readable_entities(), timeout)
+
+        return jsonify({
+            "success": True,
+            "changes": [change.format() for change in changes],
+            "cursor": changes[-1].id if changes else since
+        })
+
+    '''
+        GET /changes/stream?since=<cursor>
+        returns a text/event-stream with one event per change after the cursor (or the Last-Event-ID header)
+            or appropriate status code indicating reason for failure
+    '''
+    @app.route('/changes/stream', methods=['GET'])
+    @admission_exempt
+    @requires_auth('get:movies')
+    @rate_limited
+    def stream_changes_events():
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', 0, type=int)
+
+        events = stream_changes(since, readable_entities())
+        return Response(stream_with_context(events), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+    ### Health
+
+    '''
+        GET /health
+        returns status code 200 and json {"success": True, "database": stats, "entity_cache": cache} where stats
+            are the circuit breaker state and the statement timeout counters and cache the hit ratio of the entity
+            cache, or status code 503 while the circuit breaker is open.
+            Not counted by the admission control, so it answers while the worker is saturated
+    '''
+    @app.route('/health', methods=['GET'])
+    @admission_exempt
+    def health():
+        stats = app.extensions['db_guard'].stats()
+        healthy = stats['state'] != 'open'
+        return jsonify({
+            "success": healthy,
+            "database": stats,
+            "entity_cache": app.extensions['entity_cache'].stats()
+        }), 200 if healthy else 503
+
     ## Error Handling
 
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "bad request"
+            }), 400
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -248,6 +568,14 @@ def create_app(test_config=None):
             "message": "resouce not found"
             }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+            }), 409
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -256,6 +584,14 @@ def create_app(test_config=None):
             "message": "unprocessable"
             }), 422 
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+            }), 429, retry_after(error)
+
     @app.errorhandler(500)
     def internal_error(error):
         return jsonify({
@@ -264,6 +600,49 @@ def create_app(test_config=None):
             "message": "internal server error"
         }), 500   
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503, retry_after(error)
+
+    @app.errorhandler(CircuitOpen)
+    def circuit_open(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "database circuit open"
+        }), 503, retry_after(error)
+
+    @app.errorhandler(QueryBudgetExceeded)
+    def query_budget_exceeded(error):
+        return jsonify({
+            "success": False,
+            "error": 504,
+            "message": "query budget exceeded"
+        }), 504
+
+    '''
+        queries cancelled by the statement timeout of the route, and a database that
+        cannot be reached (which also counts towards opening the circuit breaker)
+    '''
+    @app.errorhandler(exc.OperationalError)
+    @app.errorhandler(exc.InterfaceError)
+    def database_error(error):
+        if is_query_timeout(error):
+            return jsonify({
+                "success": False,
+                "error": 504,
+                "message": "query timeout"
+            }), 504
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "database unavailable"
+        }), 503
+
 
     '''
     @DONE implement error handler for AuthError
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 from flask import request, _request_ctx_stack, jsonify
 from functools import wraps
 from jose import jwt
@@ -8,6 +9,11 @@ from urllib.request import urlopen
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('AUTH0_ALGORITHMS')
 API_AUDIENCE = os.environ.get('AUTH0_API_AUDIENCE')
+# a file:// url of the JWKS written by generate_token.py --offline accepts locally signed tokens
+JWKS_URL = os.environ.get('AUTH0_JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+
+jwks_cache = {}
 
 ## AuthError Exception
 '''
@@ -72,14 +78,23 @@ def check_permissions(permission, payload):
             }, 403)
         return False
 
+'''
+    return the JSON Web Key Set, fetched at most once per JWKS_CACHE_TTL seconds
+'''
+def get_jwks():
+    if jwks_cache.get('expires_at', 0) < time.time():
+        jsonurl = urlopen(JWKS_URL)
+        jwks_cache['jwks'] = json.loads(jsonurl.read())
+        jwks_cache['expires_at'] = time.time() + JWKS_CACHE_TTL
+    return jwks_cache['jwks']
+
 '''
     @INPUTS
         token: a json web token (string)
 
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    jwks = get_jwks()
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -129,11 +144,24 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+'''
+    return the decoded jwt payload of the authenticated request or an empty dict
+'''
+def get_current_user():
+    return getattr(_request_ctx_stack.top, 'current_user', None) or {}
+
+'''
+    return the permission checked by requires_auth for the current request
+'''
+def get_current_permission():
+    return getattr(_request_ctx_stack.top, 'current_permission', None)
+
 '''
     @INPUTS
         permission: string permission (i.e. 'post:drink')
 
-    return the decorator which passes the decoded payload to the decorated method
+    return the decorator which checks the permission and stores the decoded payload
+    and the permission on the request context (see get_current_user)
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
@@ -142,6 +170,8 @@ def requires_auth(permission=''):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
             result = check_permissions(permission, payload)
+            _request_ctx_stack.top.current_user = payload
+            _request_ctx_stack.top.current_permission = permission
             return f(*args, **kwargs)
         return wrapper
     return requires_auth_decorator
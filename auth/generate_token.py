@@ -1,34 +1,249 @@
 import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
 import collections
 import http.client
-import json
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from jose import jwt
 
-conn = http.client.HTTPSConnection("nd0044.eu.auth0.com")
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'nd0044.eu.auth0.com')
+AUDIENCE = os.environ.get('AUTH0_API_AUDIENCE', 'capstone')
 
-AUDIENCE='capstone'
+TOKEN_CACHE = os.environ.get('TOKEN_CACHE', '.tokens.json')
+# tokens expiring within this many seconds are minted again
+TOKEN_EXPIRY_MARGIN = 300
 
-CLIENT_ID = os.environ['CLIENT_ID']
-CLIENT_SECRET = os.environ['CLIENT_SECRET']
+OFFLINE_KEY = os.environ.get('OFFLINE_KEY', 'offline_key.pem')
+OFFLINE_JWKS = os.environ.get('OFFLINE_JWKS', 'offline_jwks.json')
+OFFLINE_KID = 'offline-load-test'
+OFFLINE_TOKEN_LIFETIME = 24 * 60 * 60
 
-users = []
-User = collections.namedtuple('User', 'email password env_var')
-casting_assistant = User('casting_assistant%40mail.com', os.environ['USER_PASSWORD'], 'CASTING_ASSISTANT_TOKEN')
-casting_director = User('casting_director%40mail.com', os.environ['USER_PASSWORD'], 'CASTING_DIRECTOR_TOKEN')
-executive_producer = User('executive_producer%40mail.com', os.environ['USER_PASSWORD'], 'EXECUTIVE_PRODUCER_TOKEN')
+User = collections.namedtuple('User', 'email role env_var')
 
-users.append(casting_assistant)
-users.append(casting_director)
-users.append(executive_producer)
+'''
+    permissions of the roles, as configured in Auth0
+'''
+ROLES = {
+    'casting_assistant': ['get:movies', 'get:actors'],
+    'casting_director': ['get:movies', 'get:actors', 'post:actors', 'delete:actors', 'patch:actors', 'patch:movies'],
+    'executive_producer': ['get:movies', 'get:actors', 'post:actors', 'delete:actors', 'patch:actors', 'patch:movies',
+        'post:movies', 'delete:movies'],
+}
 
-for user in users:
-    payload = f"grant_type=password&username={user.email}&password={user.password}&audience={AUDIENCE}&client_id={CLIENT_ID}&client_secret={CLIENT_SECRET}"
-    headers = { 'content-type': "application/x-www-form-urlencoded" }
+ROLE_USERS = [
+    User('casting_assistant@mail.com', 'casting_assistant', 'CASTING_ASSISTANT_TOKEN'),
+    User('casting_director@mail.com', 'casting_director', 'CASTING_DIRECTOR_TOKEN'),
+    User('executive_producer@mail.com', 'executive_producer', 'EXECUTIVE_PRODUCER_TOKEN'),
+]
+
+'''
+    load test users: loadtest+<i>@mail.com by default, they must exist in
+    Auth0 with USER_PASSWORD unless tokens are minted offline
+'''
+def load_test_users(count, role, pattern):
+    return [User(pattern.format(i=i), role, None) for i in range(count)]
+
+## Token cache
+
+'''
+TokenCache
+    tokens on disk keyed by user and audience, reused until TOKEN_EXPIRY_MARGIN
+    seconds before their exp claim. Offline tokens are also keyed by the role,
+    whose permissions they carry, and by the fingerprint of the key that signed
+    them, so a regenerated offline_key.pem does not reuse tokens it cannot verify.
+    signer is that fingerprint, or None for Auth0 tokens
+'''
+class TokenCache:
+    def __init__(self, path=TOKEN_CACHE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.tokens = json.load(f)
+        except (OSError, ValueError):
+            self.tokens = {}
+
+    def key(self, user, signer):
+        if signer is None:
+            return f'auth0:{AUDIENCE}:{user.email}'
+        return f'offline:{signer}:{AUDIENCE}:{user.role}:{user.email}'
+
+    def get(self, user, signer):
+        token = self.tokens.get(self.key(user, signer))
+        if token is None or self.expiring(token):
+            return None
+        return token
 
-    conn.request("POST", "/oauth/token", payload, headers)
+    def expiring(self, token):
+        return jwt.get_unverified_claims(token).get('exp', 0) - TOKEN_EXPIRY_MARGIN < time.time()
+
+    def set(self, user, signer, token):
+        with self.lock:
+            self.tokens[self.key(user, signer)] = token
+
+    def save(self):
+        # tokens of other keys or roles are dropped once they expire
+        tokens = {key: token for key, token in self.tokens.items() if not self.expiring(token)}
+        temporary = self.path + '.tmp'
+        with open_private(temporary) as f:
+            json.dump(tokens, f)
+        os.replace(temporary, self.path)
+
+'''
+    open a file for writing that only its owner can read, for tokens and keys.
+    The mode is also set when the file already exists with a wider one
+'''
+def open_private(path):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(path, 0o600)
+    return os.fdopen(fd, 'w')
+
+## Auth0
+
+'''
+    one keep-alive connection to Auth0 per thread
+'''
+connections = threading.local()
+
+def auth0_connection():
+    if getattr(connections, 'conn', None) is None:
+        connections.conn = http.client.HTTPSConnection(AUTH0_DOMAIN, timeout=30)
+    return connections.conn
+
+def mint_auth0_token(user):
+    payload = (f"grant_type=password&username={quote(user.email)}&password={quote(os.environ['USER_PASSWORD'])}"
+        f"&audience={AUDIENCE}&client_id={os.environ['CLIENT_ID']}&client_secret={os.environ['CLIENT_SECRET']}")
+    headers = { 'content-type': "application/x-www-form-urlencoded" }
 
-    res = conn.getresponse()
-    data = res.read()
+    for attempt in range(2):
+        conn = auth0_connection()
+        try:
+            conn.request("POST", "/oauth/token", payload, headers)
+            res = conn.getresponse()
+            data = res.read()
+            break
+        except (http.client.HTTPException, OSError):
+            # the server closed the kept alive connection, open a new one
+            conn.close()
+            connections.conn = None
+            if attempt:
+                raise
 
     data_json = json.loads(data.decode("utf-8"))
-    print(f"export {user.env_var}={data_json['access_token']}")
-    os.environ[f'{user.env_var}'] = data_json['access_token']
+    if 'access_token' not in data_json:
+        raise RuntimeError(f'{user.email}: {data_json.get("error_description", data_json)}')
+    return data_json['access_token']
+
+## Offline tokens
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+'''
+    load the offline RSA key, creating it and its JWKS the first time or
+    whenever the key was deleted.
+    Point auth.auth at the JWKS with AUTH0_JWKS_URL=file://<path of OFFLINE_JWKS>
+'''
+def offline_key():
+    from Crypto.PublicKey import RSA
+
+    generated = not os.path.exists(OFFLINE_KEY)
+    if generated:
+        key = RSA.generate(2048)
+        with open_private(OFFLINE_KEY) as f:
+            f.write(key.exportKey('PEM').decode('ascii'))
+    else:
+        with open(OFFLINE_KEY) as f:
+            key = RSA.importKey(f.read())
+
+    # a key set left by a previous key would not verify the new tokens
+    if generated or not os.path.exists(OFFLINE_JWKS):
+        jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': OFFLINE_KID,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': base64url_uint(key.n),
+            'e': base64url_uint(key.e)
+        }]}
+        with open(OFFLINE_JWKS, 'w') as f:
+            json.dump(jwks, f)
+    return key.exportKey('PEM').decode('ascii')
+
+def key_fingerprint(key):
+    return hashlib.sha256(key.encode('ascii')).hexdigest()[:16]
+
+def mint_offline_token(user, key):
+    now = int(time.time())
+    claims = {
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': f'offline|{user.email}',
+        'aud': AUDIENCE,
+        'iat': now,
+        'exp': now + OFFLINE_TOKEN_LIFETIME,
+        'permissions': ROLES[user.role]
+    }
+    return jwt.encode(claims, key, algorithm='RS256', headers={'kid': OFFLINE_KID})
+
+## Minting
+
+'''
+    tokens of the users, in order, minted concurrently with workers threads and
+    taken from the cache when still valid
+'''
+def mint_tokens(users, offline=False, workers=8, cache=None):
+    cache = cache or TokenCache()
+    key = offline_key() if offline else None
+    signer = key_fingerprint(key) if offline else None
+
+    def mint(user):
+        token = cache.get(user, signer)
+        if token is None:
+            token = mint_offline_token(user, key) if offline else mint_auth0_token(user)
+            cache.set(user, signer, token)
+        return token
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tokens = list(executor.map(mint, users))
+    cache.save()
+    return tokens
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mint Auth0 access tokens for the tests and for load generation.')
+    parser.add_argument('--users', type=int, default=0,
+        help='mint tokens for this many load test users instead of the three role users')
+    parser.add_argument('--role', choices=ROLES, default='casting_assistant',
+        help='role of the load test users, used for offline tokens')
+    parser.add_argument('--pattern', default='loadtest+{i}@mail.com', help='email of the load test users')
+    parser.add_argument('--workers', type=int, default=8, help='tokens minted concurrently')
+    parser.add_argument('--offline', action='store_true',
+        help='sign tokens with a local RSA key instead of asking Auth0')
+    parser.add_argument('--output', help='write the load test tokens to this file, one per line')
+    args = parser.parse_args(argv)
+
+    if args.users:
+        users = load_test_users(args.users, args.role, args.pattern)
+        tokens = mint_tokens(users, offline=args.offline, workers=args.workers)
+        out = open_private(args.output) if args.output else sys.stdout
+        for token in tokens:
+            out.write(token + '\n')
+        if args.output:
+            out.close()
+        return
+
+    tokens = mint_tokens(ROLE_USERS, offline=args.offline, workers=args.workers)
+    for user, token in zip(ROLE_USERS, tokens):
+        print(f"export {user.env_var}={token}")
+        os.environ[f'{user.env_var}'] = token
+    if args.offline:
+        print(f"export AUTH0_JWKS_URL=file://{os.path.abspath(OFFLINE_JWKS)}")
+
+if __name__ == '__main__':
+    main()
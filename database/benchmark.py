@@ -0,0 +1,67 @@
+import time
+from sqlalchemy import text
+from sqlalchemy.orm import lazyload
+
+from database.models import db, Movie, Actor
+from database import queries
+
+'''
+    average time in microseconds of a call to fn
+'''
+def time_per_call(fn, iterations):
+    fn()
+    started_at = time.perf_counter()
+    for i in range(iterations):
+        fn()
+        db.session.rollback()
+    return (time.perf_counter() - started_at) / iterations * 1e6
+
+'''
+    planning time reported by EXPLAIN ANALYZE for a statement, in milliseconds
+'''
+def planning_time(statement, params=None):
+    plan = db.session.execute(text(f'EXPLAIN (ANALYZE, FORMAT JSON) {statement}'), params or {}).scalar()
+    return plan[0]['Planning Time']
+
+'''
+benchmark_queries(iterations)
+    compares the per request cost of the hot path queries built by the ORM on
+    every call (as the handlers used to), baked queries and, on PostgreSQL,
+    server side prepared statements
+'''
+def benchmark_queries(iterations=1000):
+    movie_id = db.session.query(db.func.min(Movie.id)).scalar()
+    actor_id = db.session.query(db.func.min(Actor.id)).scalar()
+    # the same loader options as the baked queries, so that only building the query differs
+    movies = lambda: Movie.query.options(lazyload(Movie.actors))
+
+    cases = [
+        ('movie by id', lambda: movies().filter(Movie.id == movie_id).one_or_none(),
+            lambda: queries.MOVIE_BY_ID(db.session()).params(id=movie_id).one_or_none(),
+            lambda: queries.execute_prepared('movie_by_id', movie_id).one_or_none()),
+        ('actor by id', lambda: Actor.query.filter(Actor.id == actor_id).one_or_none(),
+            lambda: queries.ACTOR_BY_ID(db.session()).params(id=actor_id).one_or_none(),
+            lambda: queries.execute_prepared('actor_by_id', actor_id).one_or_none()),
+        ('all movies', lambda: movies().all(),
+            lambda: queries.ALL_MOVIES(db.session()).all(),
+            lambda: queries.execute_prepared('all_movies').all()),
+        ('all actors', lambda: Actor.query.all(),
+            lambda: queries.ALL_ACTORS(db.session()).all(),
+            lambda: queries.execute_prepared('all_actors').all()),
+    ]
+    postgres = db.engine.dialect.name == 'postgresql'
+
+    print(f'{"query":<12} {"orm us":>10} {"baked us":>10} {"prepared us":>12}')
+    for name, orm, baked, prepared in cases:
+        row = f'{name:<12} {time_per_call(orm, iterations):>10.1f} {time_per_call(baked, iterations):>10.1f}'
+        if postgres:
+            row += f' {time_per_call(prepared, iterations):>12.1f}'
+        print(row)
+
+    if postgres:
+        # warm the prepared statement up to its generic plan
+        for i in range(6):
+            queries.execute_prepared('movie_by_id', movie_id).all()
+        unprepared = planning_time('SELECT * FROM "Movie" WHERE id = :id', {'id': movie_id})
+        prepared = planning_time('EXECUTE movie_by_id(:id)', {'id': movie_id})
+        print(f'planning time of movie by id: {unprepared:.3f} ms unprepared, {prepared:.3f} ms prepared')
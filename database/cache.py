@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from flask import json, current_app, has_app_context
+from sqlalchemy import event
+
+from database.models import db
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+ENTITY_CACHE_BACKEND = os.environ.get('ENTITY_CACHE_BACKEND', 'memory')
+ENTITY_CACHE_URL = os.environ.get('ENTITY_CACHE_URL', 'redis://localhost:6379/0')
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 60))
+ENTITY_CACHE_NEGATIVE_TTL = float(os.environ.get('ENTITY_CACHE_NEGATIVE_TTL', 5))
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+
+# cached in place of a record to remember the id does not exist
+MISSING = 'null'
+# bumped by every invalidation, see EntityCache.get
+GENERATION_KEY = 'entity:generation'
+
+'''
+MemoryBackend
+    bounded LRU with a TTL per entry, private to the worker
+'''
+class MemoryBackend:
+    def __init__(self, max_entries=ENTITY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def current_generation(self):
+        return self.generation
+
+    '''
+        store value unless an invalidation happened since generation was read,
+        returns whether it was stored
+    '''
+    def set(self, key, value, ttl, generation):
+        with self.lock:
+            if generation != self.generation:
+                return False
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+            self.generation += 1
+
+'''
+RedisBackend
+    cache shared by all workers, so an invalidation in one worker is seen by
+    the others. Requires the redis package.
+'''
+class RedisBackend:
+    def __init__(self, url=ENTITY_CACHE_URL):
+        if redis is None:
+            raise RuntimeError('ENTITY_CACHE_BACKEND=redis requires the redis package')
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def current_generation(self):
+        return int(self.client.get(GENERATION_KEY) or 0)
+
+    '''
+        the generation is checked and the value stored in one transaction, so an
+        invalidation by any worker in between discards the value
+    '''
+    def set(self, key, value, ttl, generation):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(GENERATION_KEY)
+                if int(pipe.get(GENERATION_KEY) or 0) != generation:
+                    return False
+                pipe.multi()
+                pipe.set(key, value, px=int(ttl * 1000))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def delete(self, keys):
+        if keys:
+            pipe = self.client.pipeline()
+            pipe.delete(*keys)
+            pipe.incr(GENERATION_KEY)
+            pipe.execute()
+
+'''
+EntityCache
+    read-through cache of serialised movies and actors by id, including ids
+    that do not exist. Entries are dropped when a write to the record commits.
+    A miss only stores what it loaded if no write committed during the load,
+    otherwise the old record could be cached after its invalidation.
+'''
+class EntityCache:
+    def __init__(self, backend, ttl=ENTITY_CACHE_TTL, negative_ttl=ENTITY_CACHE_NEGATIVE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def key(self, table, id):
+        return f'entity:{table}:{id}'
+
+    '''
+        return the formatted record and whether it came from the cache.
+        The record is None if load(id) found nothing.
+    '''
+    def get(self, model, id, load):
+        key = self.key(model.__tablename__, id)
+        cached = self.backend.get(key)
+        if cached is not None:
+            self.hits += 1
+            return json.loads(cached), True
+
+        self.misses += 1
+        generation = self.backend.current_generation()
+        record = load(id)
+        if record is None:
+            self.fill(key, MISSING, self.negative_ttl, generation)
+            return None, False
+        value = json.dumps(record.format())
+        self.fill(key, value, self.ttl, generation)
+        return json.loads(value), False
+
+    def fill(self, key, value, ttl, generation):
+        if not self.backend.set(key, value, ttl, generation):
+            self.stale += 1
+
+    def invalidate(self, records):
+        self.backend.delete([self.key(table, id) for table, id in records])
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_fills': self.stale,
+            'hit_ratio': self.hits / requests if requests else None
+        }
+
+'''
+setup_entity_cache(app)
+    binds an EntityCache to the flask application
+'''
+def setup_entity_cache(app, backend=ENTITY_CACHE_BACKEND):
+    if backend == 'redis':
+        cache = EntityCache(RedisBackend())
+    else:
+        cache = EntityCache(MemoryBackend())
+    app.extensions['entity_cache'] = cache
+    return cache
+
+'''
+    entity cache of the current application, if it has one
+'''
+def current_entity_cache():
+    if has_app_context():
+        return current_app.extensions.get('entity_cache')
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_records(session):
+    records = session.info.pop('changed_records', None)
+    cache = current_entity_cache()
+    if records and cache is not None:
+        cache.invalidate(records)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_records(session):
+    session.info.pop('changed_records', None)
@@ -0,0 +1,114 @@
+import os
+import time
+import select
+import threading
+from flask import json
+from sqlalchemy import event
+
+from database.models import db, Change, CHANGES_CHANNEL
+
+CHANGE_FEED_LIMIT = int(os.environ.get('CHANGE_FEED_LIMIT', 500))
+CHANGE_FEED_POLL_TIMEOUT = float(os.environ.get('CHANGE_FEED_POLL_TIMEOUT', 30))
+CHANGE_FEED_STREAM_TIMEOUT = float(os.environ.get('CHANGE_FEED_STREAM_TIMEOUT', 300))
+CHANGE_FEED_KEEPALIVE = float(os.environ.get('CHANGE_FEED_KEEPALIVE', 15))
+
+'''
+ChangeFeed
+    wakes up requests waiting for changes. Commits in this worker notify it
+    directly; on PostgreSQL a listener thread also relays the NOTIFY sent by
+    record_change so commits in other workers wake it up too.
+'''
+class ChangeFeed:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.listener = None
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def fetch(self, since, entities, limit=CHANGE_FEED_LIMIT):
+        return Change.query.filter(Change.id > since, Change.entity.in_(entities)) \
+            .order_by(Change.id).limit(limit).all()
+
+    '''
+        return the changes after the cursor, waiting up to timeout seconds for
+        one if there are none yet
+    '''
+    def wait(self, since, entities, timeout, limit=CHANGE_FEED_LIMIT):
+        self.listen()
+        deadline = time.time() + timeout
+        while True:
+            generation = self.generation
+            changes = self.fetch(since, entities, limit)
+            remaining = deadline - time.time()
+            if changes or remaining <= 0:
+                return changes
+
+            # do not hold a pooled connection while waiting
+            db.session.rollback()
+            with self.condition:
+                self.condition.wait_for(lambda: self.generation != generation, remaining)
+
+    def listen(self):
+        if self.listener is not None or db.engine.dialect.name != 'postgresql':
+            return
+        with self.condition:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.run_listener,
+                    args=(db.engine,), daemon=True)
+                self.listener.start()
+
+    def run_listener(self, engine):
+        while True:
+            try:
+                connection = engine.raw_connection()
+                try:
+                    dbapi_connection = connection.connection
+                    dbapi_connection.set_isolation_level(0)  # autocommit
+                    dbapi_connection.cursor().execute(f'LISTEN {CHANGES_CHANNEL}')
+                    while True:
+                        if select.select([dbapi_connection], [], [], CHANGE_FEED_KEEPALIVE)[0]:
+                            dbapi_connection.poll()
+                            if dbapi_connection.notifies:
+                                del dbapi_connection.notifies[:]
+                                self.notify()
+                finally:
+                    connection.invalidate()
+            except Exception as e:
+                print(e)
+                time.sleep(1)
+
+feed = ChangeFeed()
+
+@event.listens_for(db.session, 'after_commit')
+def notify_committed_changes(session):
+    if session.info.pop('changes', False):
+        feed.notify()
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_rolled_back_changes(session):
+    session.info.pop('changes', None)
+
+'''
+    server sent events of the changes after the cursor. The stream ends after
+    CHANGE_FEED_STREAM_TIMEOUT seconds; clients reconnect with Last-Event-ID.
+'''
+def stream_changes(since, entities, duration=CHANGE_FEED_STREAM_TIMEOUT):
+    deadline = time.time() + duration
+    yield 'retry: 1000\n\n'
+    while time.time() < deadline:
+        timeout = min(CHANGE_FEED_KEEPALIVE, deadline - time.time())
+        changes = feed.wait(since, entities, timeout)
+        if not changes:
+            yield ': keepalive\n\n'
+            continue
+        for change in changes:
+            yield format_event(change)
+            since = change.id
+        db.session.rollback()
+
+def format_event(change):
+    return f'id: {change.id}\nevent: {change.operation}\ndata: {json.dumps(change.format())}\n\n'
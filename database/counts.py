@@ -0,0 +1,88 @@
+import os
+import time
+import threading
+from sqlalchemy import event, text
+
+from database.models import db
+
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 60))
+COUNT_MODES = ('exact', 'estimated', 'none')
+
+'''
+CountCache
+    exact row counts per table. Commits in this worker that change a table
+    drop its count; the TTL bounds how stale a count changed by another worker
+    can get.
+'''
+class CountCache:
+    def __init__(self, ttl=COUNT_CACHE_TTL):
+        self.ttl = ttl
+        self.counts = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def exact(self, model):
+        table = model.__tablename__
+        cached = self.counts.get(table)
+        if cached is not None and time.time() - cached[1] < self.ttl:
+            self.hits += 1
+            return cached[0]
+
+        self.misses += 1
+        generation = self.generations.get(table, 0)
+        started_at = time.time()
+        count = db.session.query(db.func.count()).select_from(model).scalar()
+        with self.lock:
+            # a commit during the query invalidated the table, do not cache a stale count
+            if self.generations.get(table, 0) == generation:
+                self.counts[table] = (count, started_at)
+        return count
+
+    def invalidate(self, tables):
+        with self.lock:
+            for table in tables:
+                self.counts.pop(table, None)
+                self.generations[table] = self.generations.get(table, 0) + 1
+
+counts = CountCache()
+
+'''
+    row count estimated like the planner does: the density reltuples/relpages
+    of the last vacuum or analyze times the current number of pages, or the
+    row estimate of EXPLAIN when the table has not been vacuumed or analyzed
+    yet (reltuples is -1 since Postgres 14, and 0 with relpages 0 before)
+'''
+def estimated_count(model):
+    if db.engine.dialect.name != 'postgresql':
+        return counts.exact(model)
+
+    table = model.__tablename__
+    row = db.session.execute(text('''
+        SELECT reltuples, relpages, pg_relation_size(oid) / current_setting('block_size')::int AS pages
+        FROM pg_class WHERE oid = to_regclass(:table)'''), {'table': f'"{table}"'}).first()
+    if row is not None and row.reltuples >= 0 and row.relpages > 0:
+        return int(round(row.reltuples / row.relpages * row.pages))
+    plan = db.session.execute(text(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "{table}"')).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+'''
+    the X-Total-Count header for a list of model in the given mode, or no header
+'''
+def total_count_header(model, mode):
+    if mode == 'exact':
+        return {'X-Total-Count': str(counts.exact(model))}
+    if mode == 'estimated':
+        return {'X-Total-Count': str(estimated_count(model))}
+    return {}
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_counts(session):
+    tables = session.info.pop('changed_tables', None)
+    if tables:
+        counts.invalidate(tables)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_tables(session):
+    session.info.pop('changed_tables', None)
@@ -0,0 +1,242 @@
+import os
+import time
+import threading
+from array import array
+from sqlalchemy import event
+
+from database.models import db, Movie, Actor, movies_actors
+
+GRAPH_INDEX_TTL = float(os.environ.get('GRAPH_INDEX_TTL', 300))
+GRAPH_OVERLAY_MAX = int(os.environ.get('GRAPH_OVERLAY_MAX', 1000))
+GRAPH_MAX_DEPTH = int(os.environ.get('GRAPH_MAX_DEPTH', 6))
+GRAPH_TIME_LIMIT = float(os.environ.get('GRAPH_TIME_LIMIT', 0.5))
+
+'''
+CSR
+    compressed sparse rows of one side of the movies_actors bipartite graph:
+    the neighbours of ids[i] are targets[offsets[i]:offsets[i + 1]]
+'''
+class CSR:
+    def __init__(self, edges):
+        ids = sorted({source for source, target in edges})
+        self.index = {id: i for i, id in enumerate(ids)}
+        self.ids = array('l', ids)
+
+        counts = [0] * (len(ids) + 1)
+        for source, target in edges:
+            counts[self.index[source] + 1] += 1
+        for i in range(len(ids)):
+            counts[i + 1] += counts[i]
+        self.offsets = array('l', counts)
+
+        targets = [0] * len(edges)
+        positions = counts[:-1]
+        for source, target in edges:
+            i = self.index[source]
+            targets[positions[i]] = target
+            positions[i] += 1
+        self.targets = array('l', targets)
+
+    def neighbours(self, id):
+        i = self.index.get(id)
+        if i is None:
+            return ()
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+'''
+CoStarIndex
+    the actor -> movies and movie -> actors CSRs built from movies_actors.
+    Keeping the graph bipartite stores every link twice instead of every pair
+    of co-stars, which grows with the square of the cast size. Links changed
+    since the build are kept in a small overlay; an index is never mutated,
+    changes produce a new one sharing the CSRs.
+'''
+class CoStarIndex:
+    def __init__(self, links, built_at=None):
+        self.actor_movies = CSR([(actor_id, movie_id) for movie_id, actor_id in links])
+        self.movie_actors = CSR([(movie_id, actor_id) for movie_id, actor_id in links])
+        self.added = frozenset()
+        self.removed = frozenset()
+        self.removed_actors = frozenset()
+        self.removed_movies = frozenset()
+        self.added_movies = {}
+        self.added_actors = {}
+        self.built_at = built_at or time.time()
+
+    def with_changes(self, added=(), removed=(), removed_actors=(), removed_movies=()):
+        index = CoStarIndex.__new__(CoStarIndex)
+        index.__dict__.update(self.__dict__)
+        # links re-added after being removed are already in the CSRs
+        index.added = (self.added - frozenset(removed)) | frozenset(
+            link for link in added if not self.in_csr(*link))
+        index.removed = (self.removed - frozenset(added)) | frozenset(
+            link for link in removed if self.in_csr(*link))
+        index.removed_actors = self.removed_actors | frozenset(removed_actors)
+        index.removed_movies = self.removed_movies | frozenset(removed_movies)
+
+        index.added_movies, index.added_actors = {}, {}
+        for movie_id, actor_id in index.added:
+            index.added_movies.setdefault(actor_id, []).append(movie_id)
+            index.added_actors.setdefault(movie_id, []).append(actor_id)
+        return index
+
+    def in_csr(self, movie_id, actor_id):
+        return movie_id in self.actor_movies.neighbours(actor_id)
+
+    def overlay_size(self):
+        return len(self.added) + len(self.removed) + len(self.removed_actors) + len(self.removed_movies)
+
+    def movies_of(self, actor_id):
+        if actor_id in self.removed_actors:
+            return []
+        movies = [movie_id for movie_id in self.actor_movies.neighbours(actor_id)
+            if movie_id not in self.removed_movies and (movie_id, actor_id) not in self.removed]
+        movies.extend(movie_id for movie_id in self.added_movies.get(actor_id, ())
+            if movie_id not in self.removed_movies)
+        return movies
+
+    def actors_of(self, movie_id):
+        if movie_id in self.removed_movies:
+            return []
+        actors = [actor_id for actor_id in self.movie_actors.neighbours(movie_id)
+            if actor_id not in self.removed_actors and (movie_id, actor_id) not in self.removed]
+        actors.extend(actor_id for actor_id in self.added_actors.get(movie_id, ())
+            if actor_id not in self.removed_actors)
+        return actors
+
+    '''
+        co-stars of an actor and the number of movies they share
+    '''
+    def costars(self, actor_id):
+        shared = {}
+        for movie_id in self.movies_of(actor_id):
+            for costar_id in self.actors_of(movie_id):
+                if costar_id != actor_id:
+                    shared[costar_id] = shared.get(costar_id, 0) + 1
+        return shared
+
+    '''
+        shortest chain of co-stars between two actors found by a bidirectional
+        breadth first search, expanding the smaller frontier one actor hop at a
+        time. Returns (actor ids, movie ids linking them, truncated) where
+        truncated tells the depth or time limit stopped the search.
+    '''
+    def path(self, source, target, max_depth=GRAPH_MAX_DEPTH, time_limit=GRAPH_TIME_LIMIT):
+        if source == target:
+            return [source], [], False
+
+        deadline = time.time() + time_limit
+        # actor id -> (previous actor id, movie id linking them)
+        parents = [{source: None}, {target: None}]
+        frontiers = [[source], [target]]
+        depth = 0
+
+        while frontiers[0] and frontiers[1]:
+            if depth >= max_depth:
+                return [], [], True
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other = parents[side], parents[1 - side]
+            next_frontier = []
+            for actor_id in frontiers[side]:
+                if time.time() > deadline:
+                    return [], [], True
+                for movie_id in self.movies_of(actor_id):
+                    for costar_id in self.actors_of(movie_id):
+                        if costar_id in seen:
+                            continue
+                        seen[costar_id] = (actor_id, movie_id)
+                        if costar_id in other:
+                            return self.join(parents, costar_id) + (False,)
+                        next_frontier.append(costar_id)
+            frontiers[side] = next_frontier
+            depth += 1
+
+        return [], [], False
+
+    def join(self, parents, meeting):
+        actors, movies = [meeting], []
+        node = meeting
+        while parents[0][node] is not None:
+            node, movie_id = parents[0][node]
+            actors.insert(0, node)
+            movies.insert(0, movie_id)
+        node = meeting
+        while parents[1][node] is not None:
+            node, movie_id = parents[1][node]
+            actors.append(node)
+            movies.append(movie_id)
+        return actors, movies
+
+'''
+CoStarGraph
+    holds the current CoStarIndex of this worker. The index is rebuilt from
+    movies_actors when it is older than GRAPH_INDEX_TTL (to pick up links
+    changed by other workers) or its overlay has grown past GRAPH_OVERLAY_MAX;
+    links committed in this worker are applied to it right away.
+'''
+class CoStarGraph:
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        index = self.index
+        if index is None or time.time() - index.built_at > GRAPH_INDEX_TTL \
+                or index.overlay_size() > GRAPH_OVERLAY_MAX:
+            with self.lock:
+                if self.index is index:
+                    links = db.session.query(movies_actors.c.movie_id, movies_actors.c.actor_id).all()
+                    self.index = CoStarIndex(links)
+                index = self.index
+        return index
+
+    '''
+        drop the index, e.g. when it refers to records deleted by another
+        worker, so the next get() rebuilds it
+    '''
+    def invalidate(self):
+        with self.lock:
+            self.index = None
+
+    def apply(self, changes):
+        with self.lock:
+            if self.index is not None:
+                self.index = self.index.with_changes(**changes)
+
+graph = CoStarGraph()
+
+'''
+    keep track of the links added or removed through Movie.actors (and the
+    Actor.movies backref) and of deleted movies and actors, resolved to ids
+    once flushed, and apply them to the index after the commit
+'''
+@event.listens_for(Movie.actors, 'append')
+def link_added(movie, actor, initiator):
+    db.session.info.setdefault('graph_links', []).append(('added', movie, actor))
+
+@event.listens_for(Movie.actors, 'remove')
+def link_removed(movie, actor, initiator):
+    db.session.info.setdefault('graph_links', []).append(('removed', movie, actor))
+
+@event.listens_for(db.session, 'after_flush')
+def collect_graph_changes(session, flush_context):
+    changes = session.info.setdefault('graph_changes',
+        {'added': [], 'removed': [], 'removed_actors': [], 'removed_movies': []})
+    for kind, movie, actor in session.info.pop('graph_links', []):
+        changes[kind].append((movie.id, actor.id))
+    for record in session.deleted:
+        if isinstance(record, Actor):
+            changes['removed_actors'].append(record.id)
+        elif isinstance(record, Movie):
+            changes['removed_movies'].append(record.id)
+
+@event.listens_for(db.session, 'after_commit')
+def apply_graph_changes(session):
+    changes = session.info.pop('graph_changes', None)
+    if changes and any(changes.values()):
+        graph.apply(changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_graph_changes(session):
+    session.info.pop('graph_links', None)
+    session.info.pop('graph_changes', None)
@@ -0,0 +1,262 @@
+import os
+import time
+import socket
+import datetime
+import threading
+from flask import json
+from sqlalchemy import or_, and_, exc
+
+from database.models import db, Job, Movie, Actor, record_change, lock_change_log
+
+JOB_LEASE = int(os.environ.get('JOB_LEASE', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 500))
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', 2))
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 1))
+
+MODELS = {'movies': Movie, 'actors': Actor}
+FIELDS = {Movie: ('title', 'release_date'), Actor: ('name', 'age', 'gender')}
+
+'''
+JobError
+    a job that cannot run, e.g. because of invalid parameters. It fails
+    straight away instead of being retried.
+'''
+class JobError(Exception):
+    pass
+
+'''
+LeaseLost
+    the lease of the job ran out and another worker claimed it. The work of the
+    current transaction is rolled back and the job is left to the new worker.
+'''
+class LeaseLost(Exception):
+    pass
+
+'''
+    write values to the job and commit, together with the work done in the
+    same transaction, unless another worker claimed the job since this attempt
+    started (fencing on the attempts counter)
+'''
+def update_job(job_id, attempt, **values):
+    updated = Job.query.filter(Job.id == job_id, Job.attempts == attempt).update(values, synchronize_session=False)
+    if not updated:
+        db.session.rollback()
+        raise LeaseLost(f'job {job_id} was claimed again after attempt {attempt}')
+    db.session.commit()
+
+'''
+Progress
+    passed to the job handlers to report how far they got. Every report commits
+    the work done since the last one with the checkpoint, the number of items
+    done, and renews the lease of the job. A handler must report at least once
+    per JOB_LEASE seconds or another worker will take the job over, and resume
+    from checkpoint.
+'''
+class Progress:
+    def __init__(self, job):
+        self.job_id = job.id
+        self.attempt = job.attempts
+        self.checkpoint = job.checkpoint or 0
+
+    def __call__(self, done, total, message=None):
+        values = {
+            'progress': round(done / total, 4) if total else 1,
+            'checkpoint': done,
+            'locked_until': lease_until()
+        }
+        if message is not None:
+            values['message'] = message
+        update_job(self.job_id, self.attempt, **values)
+        self.checkpoint = done
+
+def lease_until():
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=JOB_LEASE)
+
+def batches(items, size=JOB_BATCH_SIZE, start=0):
+    for start in range(start, len(items), size):
+        yield start, items[start:start + size]
+
+def model_for(params):
+    model = MODELS.get(params.get('entity'))
+    if model is None:
+        raise JobError('entity must be one of ' + ', '.join(MODELS))
+    return model
+
+## Job handlers
+
+'''
+    insert params['records'] into the entity table, one transaction per batch.
+    A retried job resumes after the last committed batch
+'''
+def import_records(params, progress):
+    model = model_for(params)
+    records = params.get('records') or []
+    for start, batch in batches(records, start=progress.checkpoint):
+        instances = []
+        for record in batch:
+            fields = {field: record.get(field) for field in FIELDS[model]}
+            if model is Movie:
+                fields['release_date'] = json.dumps(fields['release_date'])
+            instances.append(model(**fields))
+        # before the flush locks rows of the statistics tables
+        lock_change_log()
+        db.session.add_all(instances)
+        db.session.flush()
+        for instance in instances:
+            record_change(instance, 'insert')
+        progress(start + len(batch), len(records))
+    return {'imported': len(records)}
+
+'''
+    formatted records of the entity table, read one batch at a time
+'''
+def export_records(params, progress):
+    model = model_for(params)
+    total = model.query.count()
+    exported, last_id = [], 0
+    while True:
+        batch = model.query.filter(model.id > last_id).order_by(model.id).limit(JOB_BATCH_SIZE).all()
+        if not batch:
+            break
+        exported.extend(record.format() for record in batch)
+        last_id = batch[-1].id
+        progress(len(exported), total)
+    return {params['entity']: exported}
+
+'''
+    delete the records of the entity table with the ids in params['ids'],
+    one transaction per batch
+'''
+def bulk_delete(params, progress):
+    model = model_for(params)
+    ids = sorted(set(params.get('ids') or []))
+    deleted = 0
+    for start, batch in batches(ids, start=progress.checkpoint):
+        lock_change_log()
+        for record in model.query.filter(model.id.in_(batch)).all():
+            record_change(record, 'delete')
+            db.session.delete(record)
+            deleted += 1
+        progress(start + len(batch), len(ids))
+    return {'deleted': deleted}
+
+def refresh_statistics(params, progress):
+    from database.stats import refresh_stats
+    refresh_stats()
+    progress(1, 1)
+    return {}
+
+'''
+    job kinds with their handler and the permission needed to queue them
+'''
+JOB_KINDS = {
+    'import': (import_records, 'post:{entity}'),
+    'export': (export_records, 'get:{entity}'),
+    'bulk_delete': (bulk_delete, 'delete:{entity}'),
+    # rewrites the summary tables under EXCLUSIVE locks, so only producers may run it
+    'refresh_stats': (refresh_statistics, 'post:movies'),
+}
+
+def required_permission(kind, params):
+    return JOB_KINDS[kind][1].format(entity=params.get('entity'))
+
+## Queue
+
+def enqueue(kind, params, created_by=None):
+    job = Job(kind=kind, params=json.dumps(params), status='queued', progress=0,
+        attempts=0, created_by=created_by, created_at=datetime.datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+'''
+    take the oldest queued job, or a running one whose worker stopped renewing
+    its lease. SKIP LOCKED lets concurrent workers claim different jobs without
+    waiting for each other.
+'''
+def claim_job():
+    now = datetime.datetime.utcnow()
+    job = Job.query.filter(or_(
+            Job.status == 'queued',
+            and_(Job.status == 'running', Job.locked_until < now)
+        )).order_by(Job.id).with_for_update(skip_locked=True).first()
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.attempts += 1
+    job.started_at = now
+    job.locked_until = lease_until()
+    db.session.commit()
+    return job
+
+def run_job(job):
+    job_id, attempt = job.id, job.attempts
+    handler = JOB_KINDS[job.kind][0] if job.kind in JOB_KINDS else None
+    try:
+        if handler is None:
+            raise JobError(f'unknown job kind {job.kind}')
+        result = handler(json.loads(job.params or '{}'), Progress(job))
+        update_job(job_id, attempt, status='succeeded', progress=1, result=json.dumps(result),
+            finished_at=datetime.datetime.utcnow(), locked_until=None)
+    except LeaseLost as e:
+        print(e)
+    except Exception as e:
+        db.session.rollback()
+        print(f'job {job_id} failed: {e}')
+        # invalid records fail the same way on every attempt
+        permanent = isinstance(e, (JobError, exc.IntegrityError, exc.DataError))
+        retry = not permanent and attempt < JOB_MAX_ATTEMPTS
+        try:
+            update_job(job_id, attempt, status='queued' if retry else 'failed', message=str(e),
+                finished_at=None if retry else datetime.datetime.utcnow(), locked_until=None)
+        except LeaseLost as e:
+            print(e)
+
+'''
+    claim and run jobs until stop is set, sleeping WORKER_POLL_INTERVAL
+    seconds whenever the queue is empty or the database failed. An error that
+    escapes run_job, e.g. the connection lost while recording a failed job,
+    only ends that job: it is claimed again once its lease expires
+'''
+def work(app, stop):
+    with app.app_context():
+        while not stop.is_set():
+            job = None
+            try:
+                job = claim_job()
+                if job is not None:
+                    run_job(job)
+            except Exception as e:
+                print(f'worker: {e}')
+                job = None
+                try:
+                    db.session.rollback()
+                except Exception:
+                    pass
+            finally:
+                db.session.remove()
+            if job is None:
+                stop.wait(WORKER_POLL_INTERVAL)
+
+'''
+run_worker(app, concurrency)
+    runs concurrency threads taking jobs from the queue, so at most that many
+    jobs run at once in this process
+'''
+def run_worker(app, concurrency=WORKER_CONCURRENCY):
+    stop = threading.Event()
+    threads = [threading.Thread(target=work, args=(app, stop), daemon=True,
+        name=f'{socket.gethostname()}-worker-{i}') for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    print(f'worker started with {concurrency} threads')
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,189 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from alembic import op
+import sqlalchemy as sa
+
+# how long a migration waits for a lock before giving up. A DDL statement queued
+# behind a long transaction blocks every query queued behind it, so it is better
+# to fail fast and run the migration again
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_STATEMENT_TIMEOUT = os.environ.get('MIGRATION_STATEMENT_TIMEOUT', '0')
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 1000))
+BACKFILL_PAUSE = float(os.environ.get('BACKFILL_PAUSE', 0.1))
+BACKFILL_LOCK_RETRIES = 5
+
+LOCK_NOT_AVAILABLE = '55P03'
+
+logger = logging.getLogger('alembic.env')
+
+'''
+    set the lock and statement timeouts of a migration connection. They are set
+    for the session, so they also apply inside autocommit blocks
+'''
+def set_timeouts(connection, lock_timeout=MIGRATION_LOCK_TIMEOUT, statement_timeout=MIGRATION_STATEMENT_TIMEOUT):
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(sa.text("SELECT set_config('lock_timeout', :lock_timeout, false), "
+        "set_config('statement_timeout', :statement_timeout, false)"),
+        lock_timeout=lock_timeout, statement_timeout=statement_timeout)
+
+'''
+    run a block of a migration with other timeouts, e.g. statement_timeout='0'
+    for a constraint validation scanning a large table
+'''
+@contextmanager
+def timeouts(lock_timeout=None, statement_timeout=None):
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql' or is_offline():
+        yield
+        return
+    previous = bind.execute(sa.text("SELECT current_setting('lock_timeout'), current_setting('statement_timeout')")).first()
+    set_timeouts(bind, lock_timeout or previous[0], statement_timeout or previous[1])
+    try:
+        yield
+    finally:
+        set_timeouts(bind, previous[0], previous[1])
+
+def is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+'''
+    true when the migration only writes its SQL out (flask db upgrade --sql)
+    and nothing can be read back from the database
+'''
+def is_offline():
+    return op.get_context().as_sql
+
+def quote(name):
+    return op.get_bind().dialect.identifier_preparer.quote(name)
+
+## Indexes
+
+'''
+    CREATE INDEX CONCURRENTLY, which builds the index without blocking writes to
+    the table. It cannot run in a transaction, so the transaction of the
+    migration is committed first. A build that failed leaves an invalid index
+    behind: it is dropped and built again, so the migration can simply be rerun
+'''
+def create_index_concurrently(name, table, columns, unique=False, where=None):
+    if not is_postgres():
+        op.create_index(name, table, columns, unique=unique)
+        return
+
+    with op.get_context().autocommit_block():
+        valid = None if is_offline() else op.get_bind().execute(sa.text('''
+            SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name'''), name=name).scalar()
+        if valid:
+            return
+        if valid is not None:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+        op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True,
+            postgresql_where=sa.text(where) if where else None)
+
+def drop_index_concurrently(name, table):
+    if not is_postgres():
+        op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {quote(name)}')
+
+## Constraints
+
+'''
+    VALIDATE CONSTRAINT scans the table holding only a SHARE UPDATE EXCLUSIVE
+    lock, which does not block reads or writes. It runs after a commit, so the
+    ACCESS EXCLUSIVE lock taken when the constraint was added is already released
+'''
+def validate_constraint(name, table):
+    if not is_postgres():
+        return
+    with op.get_context().autocommit_block():
+        op.execute(f'ALTER TABLE {quote(table)} VALIDATE CONSTRAINT {quote(name)}')
+
+'''
+    add a CHECK constraint as NOT VALID, which only checks new rows, then
+    validate the existing rows without blocking writes
+'''
+def add_check_constraint(name, table, condition):
+    if not is_postgres():
+        op.create_check_constraint(name, table, condition)
+        return
+    op.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} CHECK ({condition}) NOT VALID')
+    validate_constraint(name, table)
+
+def add_foreign_key(name, table, referent, columns, referent_columns, ondelete=None):
+    if not is_postgres():
+        op.create_foreign_key(name, table, referent, columns, referent_columns, ondelete=ondelete)
+        return
+    op.execute(f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} '
+        f'FOREIGN KEY ({", ".join(map(quote, columns))}) '
+        f'REFERENCES {quote(referent)} ({", ".join(map(quote, referent_columns))})'
+        + (f' ON DELETE {ondelete}' if ondelete else '') + ' NOT VALID')
+    validate_constraint(name, table)
+
+'''
+    SET NOT NULL scans the whole table under an ACCESS EXCLUSIVE lock, unless a
+    valid CHECK (column IS NOT NULL) constraint already proves it (Postgres 12+).
+    The check is added and validated online first, then dropped
+'''
+def set_not_null(table, column):
+    if not is_postgres():
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, nullable=False)
+        return
+    check = f'{table}_{column}_not_null'.lower()
+    add_check_constraint(check, table, f'{quote(column)} IS NOT NULL')
+    op.execute(f'ALTER TABLE {quote(table)} ALTER COLUMN {quote(column)} SET NOT NULL')
+    op.execute(f'ALTER TABLE {quote(table)} DROP CONSTRAINT {quote(check)}')
+
+## Backfills
+
+'''
+    update the rows matching where in batches of batch_size, each committed on
+    its own, sleeping pause seconds between batches so that replication and
+    the other queries keep up.
+
+    values: the SET clause, e.g. "gender = 'Unknown'"
+    where: true for the rows still to update, e.g. "gender IS NULL", so that a
+    backfill interrupted midway resumes where it stopped when run again
+'''
+def backfill(table, values, where, batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE, key='id'):
+    if not is_postgres() or is_offline():
+        op.execute(f'UPDATE {quote(table)} SET {values} WHERE {where}')
+        return
+
+    table_name, key = quote(table), quote(key)
+    statement = sa.text(f'''
+        UPDATE {table_name} SET {values}
+        WHERE {key} IN (
+            SELECT {key} FROM {table_name}
+            WHERE {key} > :after AND ({where})
+            ORDER BY {key} LIMIT :batch_size
+        )
+        RETURNING {key}''')
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        after = bind.execute(sa.text(f'SELECT min({key}) - 1 FROM {table_name}')).scalar()
+        updated = 0
+        retries = 0
+        while after is not None:
+            try:
+                keys = [row[0] for row in bind.execute(statement, after=after, batch_size=batch_size)]
+            except sa.exc.OperationalError as e:
+                # rows locked by the application for longer than lock_timeout, try the batch again later
+                if getattr(e.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE or retries == BACKFILL_LOCK_RETRIES:
+                    raise
+                retries += 1
+                time.sleep(pause * 2 ** retries)
+                continue
+            retries = 0
+            if not keys:
+                break
+            after = max(keys)
+            updated += len(keys)
+            logger.info(f'backfill {table}: {updated} rows updated')
+            time.sleep(pause)
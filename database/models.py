@@ -1,6 +1,8 @@
 import os
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import text
+import datetime
 import json
 
 database_path = os.environ['DATABASE_URL']
@@ -20,13 +22,58 @@ def setup_db(app, database_path=database_path):
     migrate.init_app(app, db)
     # db.create_all()
 
+'''
+record_change(record, operation)
+    adds a row to the change log in the transaction that changes the record
+    and notifies listeners of the change feed once it is committed
+'''
+CHANGES_CHANNEL = 'catalog_changes'
+# advisory lock serialising the writers of the change log until they commit, so that
+# change ids are handed out in commit order and the id is a safe cursor for readers
+CHANGES_LOCK = 0x6368616e6765
+
+'''
+    take the change log lock. Writers call it before their first flush, as
+    flushing the record locks the rows of the statistics tables (see the stats
+    triggers): taking the lock after them lets two writers lock in opposite
+    orders and deadlock. Taking it again in the same transaction is a no-op
+'''
+def lock_change_log():
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGES_LOCK})
+
+def record_change(record, operation):
+    lock_change_log()
+    if operation == 'delete':
+        data = {'id': record.id}
+    else:
+        # read back the values as stored, i.e. release_date as a datetime
+        db.session.flush()
+        db.session.refresh(record, [column.key for column in record.__table__.columns])
+        data = record.format()
+    db.session.add(Change(
+        entity=record.__tablename__.lower(),
+        entity_id=record.id,
+        operation=operation,
+        data=json.dumps(data, default=str),
+        created_at=datetime.datetime.utcnow()
+    ))
+    db.session.info['changes'] = True
+    db.session.info.setdefault('changed_tables', set()).add(record.__tablename__)
+    db.session.info.setdefault('changed_records', set()).add((record.__tablename__, record.id))
+    if db.engine.dialect.name == 'postgresql':
+        # NOTIFY is transactional, listeners only hear about committed changes
+        db.session.execute(text('SELECT pg_notify(:channel, :entity)'),
+            {'channel': CHANGES_CHANNEL, 'entity': record.__tablename__})
+
 '''
 Movies Actors M2M table
 
 '''
 movies_actors = db.Table('movies_actors',
     db.Column('movie_id', db.Integer, db.ForeignKey('Movie.id'), primary_key=True),
-    db.Column('actor_id', db.Integer, db.ForeignKey('Actor.id'), primary_key=True)
+    db.Column('actor_id', db.Integer, db.ForeignKey('Actor.id'), primary_key=True),
+    db.Index('ix_movies_actors_actor_id', 'actor_id')
 )
 
 '''
@@ -47,13 +94,20 @@ class Movie(db.Model):
 #     self.release_date = release_date
 
     def insert(self):
+        lock_change_log()
         db.session.add(self)
+        db.session.flush()
+        record_change(self, 'insert')
         db.session.commit()
     
     def update(self):
+        lock_change_log()
+        record_change(self, 'update')
         db.session.commit()
 
     def delete(self):
+        lock_change_log()
+        record_change(self, 'delete')
         db.session.delete(self)
         db.session.commit()
 
@@ -86,13 +140,20 @@ class Actor(db.Model):
 #     self.gender = gender
 
     def insert(self):
+        lock_change_log()
         db.session.add(self)
+        db.session.flush()
+        record_change(self, 'insert')
         db.session.commit()
     
     def update(self):
+        lock_change_log()
+        record_change(self, 'update')
         db.session.commit()
 
     def delete(self):
+        lock_change_log()
+        record_change(self, 'delete')
         db.session.delete(self)
         db.session.commit()
 
@@ -105,4 +166,151 @@ class Actor(db.Model):
         }
 
     def __repr__(self):
-        return json.dumps(self.format())
\ No newline at end of file
+        return json.dumps(self.format())
+
+'''
+IdempotencyKey
+    stores the response of a POST request sent with an Idempotency-Key header
+    so retries can be replayed without inserting the record again
+'''
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        db.Index('ix_idempotency_keys_created_at', 'created_at'),
+    )
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    mimetype = db.Column(db.String(120))
+    body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(), nullable=False)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key} {self.status_code}>'
+
+
+'''
+RateLimit
+    theoretical arrival time of the next request of a rate limit key,
+    used by the shared rate limiting backend
+'''
+class RateLimit(db.Model):
+    __tablename__ = 'rate_limits'
+
+    key = db.Column(db.String(255), primary_key=True)
+    tat = db.Column(db.Float(), nullable=False)
+
+
+
+'''
+Change
+    change log of movies and actors read by the change feed. The id is the
+    cursor clients pass back to only receive newer changes.
+'''
+class Change(db.Model):
+    __tablename__ = 'changes'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(), nullable=False)
+
+    def format(self):
+        return {
+        'id': self.id,
+        'entity': self.entity,
+        'entity_id': self.entity_id,
+        'operation': self.operation,
+        'data': json.loads(self.data) if self.data else None,
+        'created_at': self.created_at
+        }
+
+
+'''
+Catalog statistics
+    summary tables kept up to date by triggers on Movie, Actor and movies_actors
+    (see migration e5b90d14a7c3) and read by the /stats endpoints
+'''
+class MoviesPerYear(db.Model):
+    __tablename__ = 'stats_movies_per_year'
+
+    year = db.Column(db.Integer, primary_key=True)
+    movies = db.Column(db.Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+        'year': self.year,
+        'movies': self.movies
+        }
+
+class ActorsByGender(db.Model):
+    __tablename__ = 'stats_actors_by_gender'
+
+    gender = db.Column(db.String(20), primary_key=True)
+    actors = db.Column(db.Integer, nullable=False, default=0)
+    aged_actors = db.Column(db.Integer, nullable=False, default=0)
+    total_age = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def format(self):
+        return {
+        'gender': self.gender,
+        'actors': self.actors,
+        'average_age': round(self.total_age / self.aged_actors, 1) if self.aged_actors else None
+        }
+
+class CastSize(db.Model):
+    __tablename__ = 'stats_cast_size'
+
+    movie_id = db.Column(db.Integer, primary_key=True)
+    actors = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+    def format(self):
+        return {
+        'movie_id': self.movie_id,
+        'actors': self.actors
+        }
+
+
+'''
+Job
+    a long running operation queued by POST /jobs and run by the worker
+    process (python manage.py worker)
+'''
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_pending', 'id', postgresql_where=text("status IN ('queued', 'running')")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    params = db.Column(db.Text)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    progress = db.Column(db.Float, nullable=False, default=0)
+    message = db.Column(db.Text)
+    result = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_by = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime(), nullable=False)
+    started_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
+    locked_until = db.Column(db.DateTime())
+    # items done by the last committed batch, where a retried job resumes
+    checkpoint = db.Column(db.Integer)
+
+    def format(self):
+        return {
+        'id': self.id,
+        'kind': self.kind,
+        'status': self.status,
+        'progress': self.progress,
+        'message': self.message,
+        'result': json.loads(self.result) if self.result else None,
+        'attempts': self.attempts,
+        'created_at': self.created_at,
+        'started_at': self.started_at,
+        'finished_at': self.finished_at
+        }
@@ -0,0 +1,91 @@
+import os
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import lazyload
+
+from database.models import db, Movie, Actor
+
+PREPARED_STATEMENTS = os.environ.get('PREPARED_STATEMENTS', 'false').lower() in ('1', 'true', 'yes')
+
+'''
+    baked queries are built and compiled to SQL once per process; later calls
+    only bind the parameters. The handlers never read Movie.actors, so the
+    lists and id lookups do not eagerly load it.
+'''
+bakery = baked.bakery()
+
+# the model is part of the cache keys, the lambdas alone are shared by both models
+def baked_all(model):
+    query = bakery(lambda session: session.query(model), model)
+    if model is Movie:
+        query.add_criteria(lambda q: q.options(lazyload(Movie.actors)))
+    return query
+
+def baked_by_id(model):
+    query = baked_all(model)
+    query.add_criteria(lambda q: q.filter(model.id == bindparam('id')), model)
+    return query
+
+MOVIE_BY_ID = baked_by_id(Movie)
+ACTOR_BY_ID = baked_by_id(Actor)
+ALL_MOVIES = baked_all(Movie)
+ALL_ACTORS = baked_all(Actor)
+
+'''
+    server side prepared statements, created with PREPARE the first time a
+    pooled connection runs them and reused for the life of the connection, so
+    Postgres skips parsing and, once it settles on a generic plan, planning.
+    Not usable behind a transaction pooling pgbouncer.
+'''
+def columns(model):
+    return ', '.join(f'"{column.name}"' for column in model.__table__.columns)
+
+STATEMENTS = {
+    'movie_by_id': (Movie, f'SELECT {columns(Movie)} FROM "Movie" WHERE id = $1'),
+    'actor_by_id': (Actor, f'SELECT {columns(Actor)} FROM "Actor" WHERE id = $1'),
+    'all_movies': (Movie, f'SELECT {columns(Movie)} FROM "Movie"'),
+    'all_actors': (Actor, f'SELECT {columns(Actor)} FROM "Actor"'),
+}
+
+EXECUTE = {}
+
+def execute_prepared(name, *params):
+    model, statement = STATEMENTS[name]
+    connection = db.session.connection()
+    prepared = connection.info.setdefault('prepared_statements', set())
+    if name not in prepared:
+        types = '(integer)' if params else ''
+        connection.execute(text(f'PREPARE {name}{types} AS {statement}'))
+        prepared.add(name)
+
+    query = EXECUTE.get(name)
+    if query is None:
+        arguments = f'(:{", :".join(f"p{i}" for i in range(len(params)))})' if params else ''
+        query = EXECUTE[name] = text(f'EXECUTE {name}{arguments}').columns(*model.__table__.columns)
+    return db.session.query(model).from_statement(query).params({f'p{i}': param for i, param in enumerate(params)})
+
+def use_prepared():
+    return PREPARED_STATEMENTS and db.engine.dialect.name == 'postgresql'
+
+'''
+    hot path lookups used by the route handlers
+'''
+def find_movie(movie_id):
+    if use_prepared():
+        return execute_prepared('movie_by_id', movie_id).one_or_none()
+    return MOVIE_BY_ID(db.session()).params(id=movie_id).one_or_none()
+
+def find_actor(actor_id):
+    if use_prepared():
+        return execute_prepared('actor_by_id', actor_id).one_or_none()
+    return ACTOR_BY_ID(db.session()).params(id=actor_id).one_or_none()
+
+def all_movies():
+    if use_prepared():
+        return execute_prepared('all_movies').all()
+    return ALL_MOVIES(db.session()).all()
+
+def all_actors():
+    if use_prepared():
+        return execute_prepared('all_actors').all()
+    return ALL_ACTORS(db.session()).all()
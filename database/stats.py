@@ -0,0 +1,51 @@
+from sqlalchemy import text
+
+from database.models import db, MoviesPerYear, ActorsByGender, CastSize
+
+'''
+    movies per release year, oldest first
+'''
+def movies_per_year():
+    rows = MoviesPerYear.query.filter(MoviesPerYear.movies > 0).order_by(MoviesPerYear.year).all()
+    return [row.format() for row in rows]
+
+'''
+    number of actors and average age per gender
+'''
+def actor_age_by_gender():
+    rows = ActorsByGender.query.filter(ActorsByGender.actors > 0).order_by(ActorsByGender.gender).all()
+    return [row.format() for row in rows]
+
+'''
+    cast size of the movies with the most actors, read through the index on
+    stats_cast_size.actors
+'''
+def largest_casts(limit):
+    rows = CastSize.query.order_by(CastSize.actors.desc(), CastSize.movie_id).limit(limit).all()
+    return [row.format() for row in rows]
+
+'''
+    recompute the summary tables from Movie, Actor and movies_actors, e.g. after
+    a bulk load with the triggers disabled. Takes a lock on the summary tables
+    so concurrent trigger updates wait for the refresh instead of being lost.
+'''
+def refresh_stats():
+    db.session.execute(text('LOCK TABLE stats_movies_per_year, stats_actors_by_gender, stats_cast_size IN EXCLUSIVE MODE'))
+    db.session.execute(text('DELETE FROM stats_movies_per_year'))
+    db.session.execute(text('DELETE FROM stats_actors_by_gender'))
+    db.session.execute(text('DELETE FROM stats_cast_size'))
+    db.session.execute(text('''
+        INSERT INTO stats_movies_per_year (year, movies)
+            SELECT extract(year FROM release_date), count(*) FROM "Movie"
+            WHERE release_date IS NOT NULL GROUP BY 1
+    '''))
+    db.session.execute(text('''
+        INSERT INTO stats_actors_by_gender (gender, actors, aged_actors, total_age)
+            SELECT coalesce(gender, 'unknown'), count(*), count(age), coalesce(sum(age), 0) FROM "Actor" GROUP BY 1
+    '''))
+    db.session.execute(text('''
+        INSERT INTO stats_cast_size (movie_id, actors)
+            SELECT "Movie".id, count(movies_actors.actor_id) FROM "Movie"
+            LEFT JOIN movies_actors ON movies_actors.movie_id = "Movie".id GROUP BY "Movie".id
+    '''))
+    db.session.commit()
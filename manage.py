@@ -3,11 +3,23 @@ from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from database.models import db
+from database.benchmark import benchmark_queries
+from database.jobs import run_worker, WORKER_CONCURRENCY
 
 migrate = Migrate(app, db)
 
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+@manager.option('-n', '--iterations', dest='iterations', type=int, default=1000)
+def benchmark(iterations):
+    '''Time the hot path queries built by the ORM, baked and prepared'''
+    benchmark_queries(iterations)
+
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=WORKER_CONCURRENCY)
+def worker(concurrency):
+    '''Run the jobs queued by POST /jobs'''
+    run_worker(app, concurrency)
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,93 @@
+import threading
+from functools import wraps
+from flask import request, current_app
+
+from auth.auth import get_current_user
+
+'''
+Call
+    a query in flight and the waiters sharing its result
+'''
+class Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+'''
+SingleFlight
+    runs at most one call per key at a time in this worker. Callers arriving
+    while a call is in flight wait for it and share its result (or exception).
+'''
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls)
+            }
+
+'''
+setup_coalescing(app)
+    binds a SingleFlight group to the flask application
+'''
+def setup_coalescing(app):
+    group = SingleFlight()
+    app.extensions['coalescing'] = group
+    return group
+
+'''
+    decorator for read handlers. Concurrent requests for the same route, query
+    string and permission scope share one query and one serialised response.
+'''
+def coalesced(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        scope = ' '.join(sorted(get_current_user().get('permissions', [])))
+        params = sorted(request.args.items(multi=True))
+        key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(params), scope)
+
+        def render():
+            response = current_app.make_response(f(*args, **kwargs))
+            return response.get_data(), response.status_code, response.headers.to_wsgi_list()
+
+        group = current_app.extensions['coalescing']
+        body, status, headers = group.do(key, render)
+        return current_app.response_class(body, status=status, headers=headers)
+    return wrapper
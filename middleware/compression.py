@@ -0,0 +1,122 @@
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+COMPRESSION_CACHE_SIZE = int(os.environ.get('COMPRESSION_CACHE_SIZE', 256))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/event-stream')
+
+ENCODINGS = (['br'] if brotli else []) + ['gzip', 'deflate']
+# zlib window bits giving a gzip or a zlib (http "deflate") container
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+'''
+    compress a whole body with the given content coding
+'''
+def compress(body, encoding, level=COMPRESSION_LEVEL):
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(body) + compressor.flush()
+
+'''
+    compress a chunked body as it is sent, flushing after every chunk so
+    streamed events are not held back in the compressor
+'''
+def compress_stream(chunks, encoding, level=COMPRESSION_LEVEL):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=min(level, 11))
+        compress_chunk = lambda chunk: compressor.process(chunk) + compressor.flush()
+        finish = compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+        compress_chunk = lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        yield compress_chunk(chunk)
+    yield finish()
+
+'''
+VariantCache
+    bounded LRU of compressed bodies keyed by the digest of the uncompressed
+    body and the content coding, so a payload served again (a cached or
+    coalesced response) is not compressed again
+'''
+class VariantCache:
+    def __init__(self, max_entries=COMPRESSION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compress(self, body, encoding):
+        key = (hashlib.sha1(body).digest(), encoding)
+        with self.lock:
+            compressed = self.entries.get(key)
+            if compressed is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        compressed = compress(body, encoding)
+        with self.lock:
+            self.entries[key] = compressed
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return compressed
+
+'''
+    the content coding to use for the current request, or None
+'''
+def negotiate_encoding():
+    return request.accept_encodings.best_match(ENCODINGS)
+
+'''
+setup_compression(app)
+    compresses json and text responses for clients that accept it
+'''
+def setup_compression(app):
+    app.config.setdefault('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE)
+    variants = VariantCache()
+    app.extensions['compression'] = variants
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or not 200 <= response.status_code < 300):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < app.config['COMPRESSION_MIN_SIZE']:
+                return response
+            response.set_data(variants.get_or_compress(body, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return variants
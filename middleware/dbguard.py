@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import threading
+import collections
+from flask import request, current_app, g, has_request_context
+from sqlalchemy import event, exc, text
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import ServiceUnavailable, GatewayTimeout
+
+from database.models import db
+from auth.auth import get_current_permission
+
+# {"get_movies": [statement timeout, query budget], "post:movies": [5000, 10000], ...} in milliseconds,
+# keyed by endpoint or permission like RATE_LIMITS. The statement timeout bounds each query, the budget
+# bounds the database time of the whole request, 0 leaves it unbounded
+STATEMENT_TIMEOUTS = json.loads(os.environ.get('STATEMENT_TIMEOUTS', '{}'))
+DEFAULT_READ_TIMEOUT = (2000, 5000)
+DEFAULT_WRITE_TIMEOUT = (5000, 10000)
+# the event stream queries the change log for as long as the client listens
+DEFAULT_TIMEOUTS = {'stream_changes_events': (2000, 0)}
+
+# the breaker opens when at least BREAKER_FAILURE_RATIO of the last BREAKER_WINDOW
+# queries failed or took longer than BREAKER_SLOW_QUERY milliseconds
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))
+BREAKER_FAILURE_RATIO = float(os.environ.get('BREAKER_FAILURE_RATIO', 0.5))
+BREAKER_SLOW_QUERY = int(os.environ.get('BREAKER_SLOW_QUERY', 1000))
+# seconds the breaker stays open before letting a probe query through
+BREAKER_RESET_TIMEOUT = int(os.environ.get('BREAKER_RESET_TIMEOUT', 10))
+
+QUERY_CANCELED = '57014'
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+'''
+CircuitOpen
+    raised instead of querying a database that is known to be unhealthy
+'''
+class CircuitOpen(ServiceUnavailable):
+    description = 'The database is unavailable.'
+
+'''
+QueryBudgetExceeded
+    raised instead of querying once a request has spent its query budget
+'''
+class QueryBudgetExceeded(GatewayTimeout):
+    description = 'The request spent its database time budget.'
+
+'''
+    true for the error of a query cancelled by statement_timeout
+'''
+def is_query_timeout(error):
+    return getattr(getattr(error, 'orig', error), 'pgcode', None) == QUERY_CANCELED
+
+'''
+CircuitBreaker
+    counts the failed and slow queries over the last window queries. Once too
+    many of them fail the breaker opens and queries fail fast with CircuitOpen.
+    After reset_timeout seconds one probe query is let through (half open): the
+    breaker closes if it succeeds and opens again if it fails.
+'''
+class CircuitBreaker:
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_ratio=BREAKER_FAILURE_RATIO,
+            reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.outcomes = collections.deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = 0
+        self.probe_started_at = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probe_started_at = now
+                return
+            # a probe that never reported back does not keep the breaker half open forever
+            if self.state == HALF_OPEN and now - self.probe_started_at >= self.reset_timeout:
+                self.probe_started_at = now
+                return
+            self.rejected += 1
+            raise CircuitOpen(retry_after=max(1, round(self.opened_at + self.reset_timeout - now)))
+
+    def record(self, failed, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self.open(now)
+                else:
+                    self.close()
+                return
+            self.outcomes.append(failed)
+            if (self.state == CLOSED and len(self.outcomes) >= self.min_calls
+                    and sum(self.outcomes) >= self.failure_ratio * len(self.outcomes)):
+                self.open(now)
+
+    def open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.opened += 1
+        self.outcomes.clear()
+
+    def close(self):
+        self.state = CLOSED
+        self.outcomes.clear()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'recent_queries': len(self.outcomes),
+            'recent_failures': sum(self.outcomes),
+            'opened': self.opened,
+            'rejected': self.rejected
+        }
+
+'''
+DatabaseGuard
+    per route statement timeouts and query budgets, and the circuit breaker of
+    the application engine
+'''
+class DatabaseGuard:
+    def __init__(self, breaker, timeouts=STATEMENT_TIMEOUTS, slow_query=BREAKER_SLOW_QUERY):
+        self.breaker = breaker
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **timeouts)
+        self.slow_query = slow_query / 1000
+        self.timed_out = 0
+        self.budget_exceeded = 0
+
+    def timeouts_for(self, endpoint, permission, method):
+        timeouts = self.timeouts.get(endpoint) or self.timeouts.get(permission)
+        if timeouts:
+            return int(timeouts[0]), int(timeouts[1])
+        return DEFAULT_READ_TIMEOUT if method in ('GET', 'HEAD') else DEFAULT_WRITE_TIMEOUT
+
+    '''
+        statement timeout in milliseconds of the next transaction of the request:
+        the one of the route, or less when the query budget is almost spent
+    '''
+    def statement_timeout(self):
+        statement_timeout, budget = self.timeouts_for(request.endpoint, get_current_permission(), request.method)
+        if budget:
+            statement_timeout = min(statement_timeout, self.remaining_budget(budget))
+        return statement_timeout
+
+    def remaining_budget(self, budget):
+        remaining = int(budget - g.get('query_time', 0) * 1000)
+        if remaining <= 0:
+            self.budget_exceeded += 1
+            raise QueryBudgetExceeded()
+        return remaining
+
+    '''
+        fails fast while the breaker is open or the query budget is spent, and
+        shortens the statement timeout of the transaction to the remaining budget
+    '''
+    def before_query(self, connection, cursor):
+        self.breaker.allow()
+        budget = self.timeouts_for(request.endpoint, get_current_permission(), request.method)[1]
+        if not budget:
+            return
+        remaining = self.remaining_budget(budget)
+        if remaining < g.get('statement_timeout', remaining) and connection.dialect.name == 'postgresql':
+            # on the cursor, so that it does not go through the engine events again
+            cursor.execute("SELECT set_config('statement_timeout', %(timeout)s, true)", {'timeout': f'{remaining}ms'})
+            g.statement_timeout = remaining
+
+    def after_query(self, elapsed):
+        self.breaker.record(elapsed > self.slow_query)
+        self.spent(elapsed)
+
+    def query_failed(self, context, elapsed):
+        if is_query_timeout(context.original_exception):
+            self.timed_out += 1
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, (exc.OperationalError, exc.InterfaceError)):
+            self.breaker.record(True)
+        self.spent(elapsed)
+
+    def spent(self, elapsed):
+        g.query_time = g.get('query_time', 0) + elapsed
+
+    def stats(self):
+        return dict(self.breaker.stats(), timed_out=self.timed_out, budget_exceeded=self.budget_exceeded)
+
+'''
+    guard of the current request, if its application has one. Queries outside
+    of a request, like the jobs of manage.py worker or the migrations of
+    manage.py db upgrade, are neither bounded nor counted by the breaker: their
+    long statements would open it for the web requests
+'''
+def current_guard():
+    if has_request_context():
+        return current_app.extensions.get('db_guard')
+
+'''
+    SET LOCAL statement_timeout at the start of every transaction of a request,
+    so it is reset when the transaction ends and never leaks to the next user
+    of the pooled connection
+'''
+@event.listens_for(db.session, 'after_begin')
+def set_statement_timeout(session, transaction, connection):
+    guard = current_guard()
+    if guard is None or connection.dialect.name != 'postgresql':
+        return
+    g.statement_timeout = guard.statement_timeout()
+    connection.execution_options(guard_internal=True).execute(
+        text("SELECT set_config('statement_timeout', :timeout, true)"), timeout=f'{g.statement_timeout}ms')
+
+'''
+    statements of the guard itself. They are not application queries: they do not
+    count towards the budget, and a success must not close a half open breaker or
+    dilute the failure ratio of the real queries. Their failures still count.
+'''
+def is_internal(context):
+    return context is not None and context.execution_options.get('guard_internal', False)
+
+'''
+    the engine events are listened to on every engine, as Flask-SQLAlchemy creates
+    a new one whenever setup_db runs again, and go to the guard of the request
+'''
+@event.listens_for(Engine, 'do_connect')
+def before_connect(dialect, connection_record, cargs, cparams):
+    guard = current_guard()
+    if guard is not None:
+        # do not wait for the connect timeout of a database known to be down
+        guard.breaker.allow()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    guard = current_guard()
+    if guard is not None and not is_internal(context):
+        guard.before_query(conn, cursor)
+        conn.info.setdefault('query_started_at', []).append(time.time())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    guard = current_guard()
+    if guard is not None and not is_internal(context) and conn.info.get('query_started_at'):
+        guard.after_query(time.time() - conn.info['query_started_at'].pop())
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    guard = current_guard()
+    if guard is None:
+        return
+    elapsed = 0
+    if (context.connection is not None and not is_internal(context.execution_context)
+            and context.connection.info.get('query_started_at')):
+        elapsed = time.time() - context.connection.info['query_started_at'].pop()
+    guard.query_failed(context, elapsed)
+
+'''
+setup_db_guard(app)
+    binds a DatabaseGuard to the flask application
+'''
+def setup_db_guard(app):
+    guard = DatabaseGuard(CircuitBreaker())
+    app.extensions['db_guard'] = guard
+    return guard
@@ -0,0 +1,275 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, current_app, abort
+from sqlalchemy import exc
+
+from auth.auth import get_current_user
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 30))
+# seconds a reservation is held for a request in flight, after which another
+# request may take it over, e.g. when the worker holding it was killed
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 60))
+# seconds between two deletions of the expired rows of the idempotency_keys table
+IDEMPOTENCY_CLEANUP_INTERVAL = int(os.environ.get('IDEMPOTENCY_CLEANUP_INTERVAL', 300))
+
+'''
+StoredResponse
+    the parts of a response needed to replay it
+'''
+class StoredResponse:
+    def __init__(self, fingerprint, status_code, mimetype, body, created_at=None):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.mimetype = mimetype
+        self.body = body
+        self.created_at = created_at or time.time()
+
+    def expired(self, ttl):
+        return time.time() - self.created_at > ttl
+
+'''
+MemoryBackend
+    bounded LRU of stored responses kept in the worker process
+'''
+class MemoryBackend:
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_keys=IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expired(self.ttl):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def reserve(self, key, fingerprint):
+        # requests in the same process are already serialised by the store
+        return True
+
+    def save(self, key, entry, reservation=None):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+
+    def release(self, key, reservation=None):
+        pass
+
+'''
+DatabaseBackend
+    shares stored responses between workers through the idempotency_keys table.
+    A row without status_code is a reservation held by a request in flight for
+    at most lease seconds. Every cleanup_interval seconds the rows of expired
+    responses and reservations are deleted, so the table does not grow with
+    keys that are never sent again.
+    Completed entries are also kept in a local MemoryBackend so replays in the
+    same worker do not query the database.
+'''
+class DatabaseBackend:
+    def __init__(self, db, ttl=IDEMPOTENCY_TTL, max_keys=IDEMPOTENCY_MAX_KEYS, lease=IDEMPOTENCY_LEASE,
+            cleanup_interval=IDEMPOTENCY_CLEANUP_INTERVAL):
+        from database.models import IdempotencyKey
+        self.db = db
+        self.table = IdempotencyKey.__table__
+        self.ttl = ttl
+        self.lease = lease
+        self.cleanup_interval = cleanup_interval
+        self.cleaned_at = 0
+        self.local = MemoryBackend(ttl, max_keys)
+
+    def _cutoff(self, seconds=None):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl if seconds is None else seconds)
+
+    def _expired(self):
+        return (((self.table.c.status_code != None) & (self.table.c.created_at <= self._cutoff()))
+            | ((self.table.c.status_code == None) & (self.table.c.created_at <= self._cutoff(self.lease))))
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+
+        with self.db.engine.connect() as conn:
+            row = conn.execute(self.table.select().where(
+                (self.table.c.key == key)
+                & (self.table.c.status_code != None)
+                & (self.table.c.created_at > self._cutoff()))).first()
+        if row is None:
+            return None
+
+        entry = StoredResponse(row.fingerprint, row.status_code, row.mimetype, row.body,
+            created_at=(row.created_at - datetime.datetime(1970, 1, 1)).total_seconds())
+        self.local.save(key, entry)
+        return entry
+
+    '''
+        delete the expired responses and reservations of all keys
+    '''
+    def cleanup(self):
+        self.cleaned_at = time.time()
+        with self.db.engine.begin() as conn:
+            return conn.execute(self.table.delete().where(self._expired())).rowcount
+
+    '''
+        returns the reservation, the time it was taken, or None if the key is
+        already reserved. An expired response or reservation of the key is
+        taken over.
+    '''
+    def reserve(self, key, fingerprint):
+        if time.time() - self.cleaned_at >= self.cleanup_interval:
+            self.cleanup()
+        else:
+            with self.db.engine.begin() as conn:
+                conn.execute(self.table.delete().where((self.table.c.key == key) & self._expired()))
+        reservation = datetime.datetime.utcnow()
+        try:
+            with self.db.engine.begin() as conn:
+                conn.execute(self.table.insert().values(
+                    key=key, fingerprint=fingerprint, created_at=reservation))
+            return reservation
+        except exc.IntegrityError:
+            return None
+
+    def _reserved(self, key, reservation):
+        return ((self.table.c.key == key) & (self.table.c.status_code == None)
+            & (self.table.c.created_at == reservation))
+
+    '''
+        save and release only touch the row while it still holds the reservation
+        of the request, not one taken over after its lease expired
+    '''
+    def save(self, key, entry, reservation=None):
+        with self.db.engine.begin() as conn:
+            saved = conn.execute(self.table.update().where(self._reserved(key, reservation)).values(
+                status_code=entry.status_code, mimetype=entry.mimetype, body=entry.body,
+                created_at=datetime.datetime.utcnow())).rowcount
+        if saved:
+            self.local.save(key, entry)
+
+    def release(self, key, reservation=None):
+        with self.db.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self._reserved(key, reservation)))
+
+'''
+IdempotencyStore
+    runs a request at most once per key. Concurrent requests with the same key
+    in this process wait for the first one and replay its response; a request
+    in flight in another worker is answered with 409 Conflict.
+'''
+class IdempotencyStore:
+    def __init__(self, backend, wait=IDEMPOTENCY_WAIT):
+        self.backend = backend
+        self.wait = wait
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.replayed = 0
+        self.coalesced = 0
+
+    def execute(self, key, fingerprint, f):
+        while True:
+            entry = self.backend.get(key)
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    abort(422)
+                self.replayed += 1
+                return self.replay(entry)
+
+            with self.lock:
+                event = self.inflight.get(key)
+                leader = event is None
+                if leader:
+                    event = self.inflight[key] = threading.Event()
+
+            if not leader:
+                self.coalesced += 1
+                if not event.wait(self.wait):
+                    abort(409)
+                if self.backend.get(key) is None:
+                    # the first request failed, its error is not replayed
+                    abort(409)
+                continue
+
+            try:
+                return self.run(key, fingerprint, f)
+            finally:
+                with self.lock:
+                    self.inflight.pop(key, None)
+                event.set()
+
+    def run(self, key, fingerprint, f):
+        reservation = self.backend.reserve(key, fingerprint)
+        if not reservation:
+            abort(409)
+
+        try:
+            response = current_app.make_response(f())
+        except Exception:
+            self.backend.release(key, reservation)
+            raise
+
+        if 200 <= response.status_code < 300:
+            self.backend.save(key, StoredResponse(fingerprint, response.status_code,
+                response.mimetype, response.get_data(as_text=True)), reservation)
+        else:
+            self.backend.release(key, reservation)
+        return response
+
+    def replay(self, entry):
+        response = current_app.response_class(entry.body,
+            status=entry.status_code, mimetype=entry.mimetype)
+        response.headers[REPLAYED_HEADER] = 'true'
+        return response
+
+'''
+setup_idempotency(app)
+    binds an IdempotencyStore to the flask application
+'''
+def setup_idempotency(app, backend=IDEMPOTENCY_BACKEND):
+    if backend == 'database':
+        from database.models import db
+        store = IdempotencyStore(DatabaseBackend(db))
+    else:
+        store = IdempotencyStore(MemoryBackend())
+    app.extensions['idempotency'] = store
+    return store
+
+'''
+    decorator for POST handlers. Requests without an Idempotency-Key header are
+    handled as usual. Keys are scoped to the caller and the route, and the
+    request body must match the one first sent with the key.
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 200:
+            abort(400)
+
+        principal = get_current_user().get('sub', '')
+        scoped_key = f'{principal}:{request.method}:{request.path}:{key}'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        store = current_app.extensions['idempotency']
+        return store.execute(scoped_key, fingerprint, lambda: f(*args, **kwargs))
+    return wrapper
@@ -0,0 +1,153 @@
+import os
+import json
+import math
+import time
+import threading
+from functools import wraps
+from flask import request, current_app, g
+from sqlalchemy import text
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+
+from auth.auth import get_current_user, get_current_permission
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+# {"post:movies": [rate per second, burst], "get_actors": [20, 40], ...}
+RATE_LIMITS = json.loads(os.environ.get('RATE_LIMITS', '{}'))
+DEFAULT_READ_LIMIT = (20.0, 40)
+DEFAULT_WRITE_LIMIT = (2.0, 10)
+# keep the admitted requests below the SQLAlchemy pool size plus overflow (5 + 10)
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 15))
+ADMISSION_RETRY_AFTER = 1
+
+'''
+MemoryBackend
+    GCRA (a token bucket kept as a single theoretical arrival time per key).
+    There is no lock: each check is one dict read and one dict write, so racing
+    threads can at worst let through one extra request each.
+'''
+class MemoryBackend:
+    def __init__(self):
+        self.tats = {}
+
+    def hit(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        interval = 1.0 / rate
+        tat = max(self.tats.get(key, now), now) + interval
+        allow_at = tat - burst * interval
+        if allow_at > now:
+            return allow_at - now
+        self.tats[key] = tat
+        return 0
+
+'''
+DatabaseBackend
+    the same algorithm shared between workers with one upsert on the unlogged
+    rate_limits table
+'''
+class DatabaseBackend:
+    def __init__(self, db):
+        self.db = db
+
+    def hit(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        interval = 1.0 / rate
+        with self.db.engine.begin() as conn:
+            row = conn.execute(text('''
+                INSERT INTO rate_limits (key, tat) VALUES (:key, :now + :interval)
+                ON CONFLICT (key) DO UPDATE
+                    SET tat = (CASE WHEN rate_limits.tat > :now THEN rate_limits.tat ELSE :now END) + :interval
+                    WHERE (CASE WHEN rate_limits.tat > :now THEN rate_limits.tat ELSE :now END) + :interval - :window <= :now
+                RETURNING tat
+            '''), key=key, now=now, interval=interval, window=burst * interval).first()
+            if row is not None:
+                return 0
+            tat = conn.execute(text('SELECT tat FROM rate_limits WHERE key = :key'), key=key).scalar()
+        return max(tat, now) + interval - burst * interval - now
+
+'''
+RateLimiter
+    looks up the limit of a route and checks it against the backend
+'''
+class RateLimiter:
+    def __init__(self, backend, limits=RATE_LIMITS):
+        self.backend = backend
+        self.limits = limits
+        self.limited = 0
+
+    def limit_for(self, endpoint, permission, method):
+        limit = self.limits.get(endpoint) or self.limits.get(permission)
+        if limit:
+            return float(limit[0]), int(limit[1])
+        return DEFAULT_READ_LIMIT if method in ('GET', 'HEAD') else DEFAULT_WRITE_LIMIT
+
+    def check(self, principal, endpoint, permission, method):
+        rate, burst = self.limit_for(endpoint, permission, method)
+        wait = self.backend.hit(f'{principal}:{permission}:{endpoint}', rate, burst)
+        if wait > 0:
+            self.limited += 1
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+'''
+AdmissionControl
+    caps the requests handled at once by a worker so the database pool is never
+    exhausted; requests over the cap are shed with 503 instead of queueing
+'''
+class AdmissionControl:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_REQUESTS):
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.shed = 0
+
+    def admit(self):
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'admission_exempt', False):
+            return
+        if not self.slots.acquire(blocking=False):
+            self.shed += 1
+            raise ServiceUnavailable(retry_after=ADMISSION_RETRY_AFTER)
+        g.admitted = True
+
+    def release(self, error=None):
+        if g.pop('admitted', False):
+            self.slots.release()
+
+'''
+    decorator for the routes not counted by the admission control: the change
+    feed streams and long polls, which wait most of the time without holding
+    a database connection, and the health check
+'''
+def admission_exempt(f):
+    f.admission_exempt = True
+    return f
+
+'''
+setup_rate_limiting(app)
+    binds a RateLimiter and the admission control hooks to the flask application
+'''
+def setup_rate_limiting(app, backend=RATE_LIMIT_BACKEND):
+    if backend == 'database':
+        from database.models import db
+        limiter = RateLimiter(DatabaseBackend(db))
+    else:
+        limiter = RateLimiter(MemoryBackend())
+    admission = AdmissionControl()
+
+    app.before_request(admission.admit)
+    app.teardown_request(admission.release)
+    app.extensions['rate_limiting'] = limiter
+    app.extensions['admission'] = admission
+    return limiter
+
+'''
+    decorator applied below requires_auth. Limits are kept per user (the jwt
+    sub), permission and endpoint, so routes sharing a permission do not share
+    a bucket.
+'''
+def rate_limited(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        limiter = current_app.extensions['rate_limiting']
+        limiter.check(get_current_user().get('sub', request.remote_addr),
+            request.endpoint, get_current_permission(), request.method)
+        return f(*args, **kwargs)
+    return wrapper
@@ -22,6 +22,7 @@ logger = logging.getLogger('alembic.env')
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from flask import current_app
+from database.migration_ops import set_timeouts
 config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
@@ -78,10 +79,17 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        # fail fast instead of queueing behind long transactions and blocking
+        # the application queries queued behind the migration
+        set_timeouts(connection)
+
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            # commit each migration on its own, which the autocommit blocks of
+            # database.migration_ops expect and which keeps locks short
+            transaction_per_migration=True,
             **current_app.extensions['migrate'].configure_args
         )
 
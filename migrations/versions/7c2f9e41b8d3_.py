@@ -0,0 +1,24 @@
+"""index idempotency_keys by creation time, built concurrently
+
+Revision ID: 7c2f9e41b8d3
+Revises: d31c8f6a2b47
+Create Date: 2026-10-20 14:31:07.126440
+
+"""
+from database.migration_ops import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2f9e41b8d3'
+down_revision = 'd31c8f6a2b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the periodic cleanup deletes the expired keys by created_at
+    create_index_concurrently('ix_idempotency_keys_created_at', 'idempotency_keys', ['created_at'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_idempotency_keys_created_at', 'idempotency_keys')
@@ -0,0 +1,30 @@
+"""add rate limits table
+
+Revision ID: 8d2e4b61c0a5
+Revises: 3f1c2a9d7b4e
+Create Date: 2026-10-19 11:40:03.527719
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4b61c0a5'
+down_revision = '3f1c2a9d7b4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_limits',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('tat', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    # rate limit state is disposable, skip the WAL
+    op.execute('ALTER TABLE rate_limits SET UNLOGGED')
+
+
+def downgrade():
+    op.drop_table('rate_limits')
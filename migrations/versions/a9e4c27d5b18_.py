@@ -0,0 +1,25 @@
+"""index movies_actors by actor, built concurrently
+
+Revision ID: a9e4c27d5b18
+Revises: 1b7f3e20c96d
+Create Date: 2026-10-19 20:48:02.311905
+
+"""
+from database.migration_ops import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9e4c27d5b18'
+down_revision = '1b7f3e20c96d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the primary key (movie_id, actor_id) does not help to find the movies of
+    # an actor, which the co-star graph and the actor deletes do
+    create_index_concurrently('ix_movies_actors_actor_id', 'movies_actors', ['actor_id'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_movies_actors_actor_id', 'movies_actors')
@@ -0,0 +1,25 @@
+"""add the checkpoint of jobs
+
+Revision ID: d31c8f6a2b47
+Revises: a9e4c27d5b18
+Create Date: 2026-10-20 09:12:44.508213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd31c8f6a2b47'
+down_revision = 'a9e4c27d5b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # nullable without a default, so adding it does not rewrite the table
+    op.add_column('jobs', sa.Column('checkpoint', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('jobs', 'checkpoint')
@@ -0,0 +1,129 @@
+"""add catalog statistics summary tables and triggers
+
+Revision ID: e5b90d14a7c3
+Revises: c47a1e93d2f8
+Create Date: 2026-10-19 16:22:37.604112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b90d14a7c3'
+down_revision = 'c47a1e93d2f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stats_movies_per_year',
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column('movies', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('year')
+    )
+    op.create_table('stats_actors_by_gender',
+    sa.Column('gender', sa.String(length=20), nullable=False),
+    sa.Column('actors', sa.Integer(), nullable=False),
+    sa.Column('aged_actors', sa.Integer(), nullable=False),
+    sa.Column('total_age', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('gender')
+    )
+    op.create_table('stats_cast_size',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actors', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('movie_id')
+    )
+    op.create_index('ix_stats_cast_size_actors', 'stats_cast_size', ['actors'])
+
+    op.execute('''
+    CREATE FUNCTION stats_movie_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO stats_cast_size (movie_id, actors) VALUES (NEW.id, 0)
+            ON CONFLICT (movie_id) DO NOTHING;
+        ELSIF TG_OP = 'DELETE' THEN
+            DELETE FROM stats_cast_size WHERE movie_id = OLD.id;
+        END IF;
+
+        IF TG_OP = 'UPDATE' AND OLD.release_date IS NOT DISTINCT FROM NEW.release_date THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.release_date IS NOT NULL THEN
+            UPDATE stats_movies_per_year SET movies = movies - 1
+            WHERE year = extract(year FROM OLD.release_date);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.release_date IS NOT NULL THEN
+            INSERT INTO stats_movies_per_year (year, movies) VALUES (extract(year FROM NEW.release_date), 1)
+            ON CONFLICT (year) DO UPDATE SET movies = stats_movies_per_year.movies + 1;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION stats_actor_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE stats_actors_by_gender SET
+                actors = actors - 1,
+                aged_actors = aged_actors - (OLD.age IS NOT NULL)::int,
+                total_age = total_age - coalesce(OLD.age, 0)
+            WHERE gender = coalesce(OLD.gender, 'unknown');
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO stats_actors_by_gender (gender, actors, aged_actors, total_age)
+            VALUES (coalesce(NEW.gender, 'unknown'), 1, (NEW.age IS NOT NULL)::int, coalesce(NEW.age, 0))
+            ON CONFLICT (gender) DO UPDATE SET
+                actors = stats_actors_by_gender.actors + 1,
+                aged_actors = stats_actors_by_gender.aged_actors + EXCLUDED.aged_actors,
+                total_age = stats_actors_by_gender.total_age + EXCLUDED.total_age;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION stats_cast_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE stats_cast_size SET actors = actors + 1 WHERE movie_id = NEW.movie_id;
+        ELSE
+            UPDATE stats_cast_size SET actors = actors - 1 WHERE movie_id = OLD.movie_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER stats_movie AFTER INSERT OR UPDATE OR DELETE ON "Movie"
+        FOR EACH ROW EXECUTE PROCEDURE stats_movie_changed();
+    CREATE TRIGGER stats_actor AFTER INSERT OR UPDATE OF age, gender OR DELETE ON "Actor"
+        FOR EACH ROW EXECUTE PROCEDURE stats_actor_changed();
+    CREATE TRIGGER stats_cast AFTER INSERT OR DELETE ON movies_actors
+        FOR EACH ROW EXECUTE PROCEDURE stats_cast_changed();
+    ''')
+
+    # summarise the existing rows
+    op.execute('''
+    INSERT INTO stats_movies_per_year (year, movies)
+        SELECT extract(year FROM release_date), count(*) FROM "Movie"
+        WHERE release_date IS NOT NULL GROUP BY 1;
+    INSERT INTO stats_actors_by_gender (gender, actors, aged_actors, total_age)
+        SELECT coalesce(gender, 'unknown'), count(*), count(age), coalesce(sum(age), 0) FROM "Actor" GROUP BY 1;
+    INSERT INTO stats_cast_size (movie_id, actors)
+        SELECT "Movie".id, count(movies_actors.actor_id) FROM "Movie"
+        LEFT JOIN movies_actors ON movies_actors.movie_id = "Movie".id GROUP BY "Movie".id;
+    ''')
+
+
+def downgrade():
+    op.execute('''
+    DROP TRIGGER stats_cast ON movies_actors;
+    DROP TRIGGER stats_actor ON "Actor";
+    DROP TRIGGER stats_movie ON "Movie";
+    DROP FUNCTION stats_cast_changed();
+    DROP FUNCTION stats_actor_changed();
+    DROP FUNCTION stats_movie_changed();
+    ''')
+    op.drop_index('ix_stats_cast_size_actors', table_name='stats_cast_size')
+    op.drop_table('stats_cast_size')
+    op.drop_table('stats_actors_by_gender')
+    op.drop_table('stats_movies_per_year')
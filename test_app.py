@@ -1,10 +1,22 @@
 import os
+import gzip
+import random
+import time
+import threading
 import unittest
 import json
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import exc
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
 
 from app import create_app
-from database.models import setup_db, Movie, Actor
+from database.models import setup_db, db, Movie, Actor, CHANGES_LOCK
+from database.graph import CoStarIndex
+from database.migration_ops import set_timeouts, backfill, create_index_concurrently, set_not_null
+from database.jobs import claim_job, run_job, work
+from middleware.idempotency import DatabaseBackend, StoredResponse
 
 
 class CapstonesTestCase(unittest.TestCase):
@@ -222,6 +234,539 @@ class CapstonesTestCase(unittest.TestCase):
         self.assertEqual(len(data['actors']), 1)
         self.assertEqual(data['actors'][0]['name'], 'Tom Hanks')
 
+    def test_concurrent_post_and_patch_actor_do_not_deadlock(self):
+        responses = []
+        def send(method, path):
+            res = self.client().open(path, method=method, headers=self.headers_executive_producer, json=self.new_actor)
+            responses.append((method, res.status_code, json.loads(res.data)))
+
+        def wait_for_lock_waiters(conn, waiters):
+            deadline = time.time() + 2
+            while time.time() < deadline and conn.execute(
+                    "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND NOT granted").scalar() < waiters:
+                time.sleep(0.01)
+
+        with self.app.app_context():
+            # hold the change log so the PATCH queues first and the POST behind it. The POST must
+            # not lock the Male statistics row the PATCH updates once it is let through
+            holder = db.engine.connect()
+            transaction = holder.begin()
+            holder.execute('SELECT pg_advisory_xact_lock(%s)', CHANGES_LOCK)
+            observer = db.engine.connect()
+            patch = threading.Thread(target=send, args=('PATCH', '/actors/1'))
+            patch.start()
+            wait_for_lock_waiters(observer, 1)
+            post = threading.Thread(target=send, args=('POST', '/actors'))
+            post.start()
+            wait_for_lock_waiters(observer, 2)
+            time.sleep(0.2)
+            transaction.rollback()
+            holder.close()
+            patch.join()
+            post.join()
+            observer.close()
+
+        self.assertEqual([status for method, status, data in responses], [200, 200])
+        created = next(data['created'] for method, status, data in responses if method == 'POST')
+        res = self.client().delete(f'/actors/{created}', headers=self.headers_executive_producer)
+        self.assertEqual(res.status_code, 200)
+
+    def test_post_new_actor_with_idempotency_key_is_replayed(self):
+        headers = dict(self.headers_casting_director, **{'Idempotency-Key': 'test-post-actor'})
+        res = self.client().post('/actors', headers=headers, json=self.new_actor)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+
+        res2 = self.client().post('/actors', headers=headers, json=self.new_actor)
+        data2 = json.loads(res2.data)
+        self.assertEqual(res2.status_code, 200)
+        self.assertEqual(res2.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(data2['created'], data['created'])
+
+        # a different body with the same key is rejected
+        res3 = self.client().post('/actors', headers=headers, json={'name': 'James Dean'})
+        self.assertEqual(res3.status_code, 422)
+
+        res4 = self.client().delete(f'/actors/{data["created"]}',  headers=self.headers_casting_director)
+        self.assertEqual(res4.status_code, 200)
+
+    def test_idempotency_reservation_is_taken_over_after_its_lease(self):
+        with self.app.app_context():
+            backend = DatabaseBackend(db, ttl=0, lease=0)
+            first = backend.reserve('test-lease', 'fingerprint')
+            second = backend.reserve('test-lease', 'fingerprint')
+            self.assertTrue(second)
+
+            # the request that lost its reservation does not store its response
+            backend.save('test-lease', StoredResponse('fingerprint', 200, 'application/json', '{}'), first)
+            self.assertIsNone(backend.get('test-lease'))
+
+            backend.save('test-lease', StoredResponse('fingerprint', 200, 'application/json', '{}'), second)
+            self.assertEqual(backend.cleanup(), 1)
+
+    def test_get_movies_runs_through_single_flight_group(self):
+        res = self.client().get('/movies', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 3)
+        stats = self.app.extensions['coalescing'].stats()
+        self.assertEqual(stats['executed'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_concurrent_get_movies_share_one_query(self):
+        bodies = []
+        def get_movies():
+            res = self.client().get('/movies', headers=self.headers_casting_assistant)
+            bodies.append((res.status_code, res.data))
+
+        group = self.app.extensions['coalescing']
+        with self.app.app_context():
+            # the first request waits for the lock, the others join it meanwhile
+            conn = db.engine.connect()
+            transaction = conn.begin()
+            conn.execute('LOCK TABLE "Movie" IN ACCESS EXCLUSIVE MODE')
+            threads = [threading.Thread(target=get_movies) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            deadline = time.time() + 1
+            while group.stats()['coalesced'] < 4 and time.time() < deadline:
+                time.sleep(0.01)
+            transaction.rollback()
+            conn.close()
+        for thread in threads:
+            thread.join()
+
+        stats = group.stats()
+        self.assertGreater(stats['coalesced'], 0)
+        self.assertEqual(stats['executed'] + stats['coalesced'], 5)
+        self.assertEqual(len(bodies), 5)
+        self.assertEqual(bodies[0][0], 200)
+        self.assertTrue(all(body == bodies[0] for body in bodies))
+
+    def test_429_get_movies_over_rate_limit(self):
+        self.app.extensions['rate_limiting'].limits = {'get:movies': [1, 1]}
+        res = self.client().get('/movies', headers=self.headers_casting_assistant)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/movies', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['message'], "too many requests")
+        self.assertTrue(res.headers.get('Retry-After'))
+
+    def test_get_actors_gzip_compressed(self):
+        self.app.config['COMPRESSION_MIN_SIZE'] = 0
+        headers = dict(self.headers_casting_assistant, **{'Accept-Encoding': 'gzip'})
+        res = self.client().get('/actors', headers=headers)
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('Content-Encoding'), 'gzip')
+        self.assertIn('Accept-Encoding', res.headers.get('Vary'))
+        self.assertEqual(len(data['actors']), 4)
+
+    def test_get_changes_after_patch_actor(self):
+        res = self.client().get('/changes?since=0&timeout=0', headers=self.headers_casting_assistant)
+        cursor = json.loads(res.data)['cursor']
+
+        res = self.client().patch('/actors/1', headers=self.headers_casting_director, json=self.new_actor)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(f'/changes?since={cursor}&timeout=0', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['changes'][-1]['entity'], 'actor')
+        self.assertEqual(data['changes'][-1]['entity_id'], 1)
+        self.assertEqual(data['changes'][-1]['operation'], 'update')
+        self.assertEqual(data['cursor'], data['changes'][-1]['id'])
+
+    def test_get_costars_and_path_without_links(self):
+        res = self.client().get('/actors/1/costars', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor'], 1)
+        self.assertEqual(data['costars'], [])
+
+        res = self.client().get('/actors/1/path/2', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['degrees'], None)
+        self.assertEqual(data['actors'], [])
+
+    # (movie id, actor id) links: actors 1 and 2 share movies 10 and 13, then 2 - 3 - 4 form a chain
+    costar_links = [(10, 1), (10, 2), (11, 2), (11, 3), (12, 3), (12, 4), (13, 1), (13, 2)]
+
+    def assertValidPath(self, index, actors, movies):
+        self.assertEqual(len(movies), len(actors) - 1)
+        for i, movie_id in enumerate(movies):
+            self.assertIn(actors[i], index.actors_of(movie_id))
+            self.assertIn(actors[i + 1], index.actors_of(movie_id))
+
+    def test_costar_index_costars_and_path(self):
+        index = CoStarIndex(self.costar_links)
+        self.assertEqual(index.costars(1), {2: 2})
+        self.assertEqual(index.costars(2), {1: 2, 3: 1})
+
+        actors, movies, truncated = index.path(1, 4)
+        self.assertEqual(actors, [1, 2, 3, 4])
+        self.assertValidPath(index, actors, movies)
+        self.assertFalse(truncated)
+
+        self.assertEqual(index.path(1, 1), ([1], [], False))
+        self.assertEqual(index.path(1, 99), ([], [], False))
+
+    def test_costar_index_path_is_truncated(self):
+        index = CoStarIndex(self.costar_links)
+        self.assertEqual(index.path(1, 4, max_depth=2), ([], [], True))
+        self.assertEqual(len(index.path(1, 4, max_depth=3)[0]), 4)
+        self.assertEqual(index.path(1, 4, time_limit=-1), ([], [], True))
+
+    def test_costar_index_with_changes(self):
+        index = CoStarIndex(self.costar_links)
+
+        added = index.with_changes(added=[(14, 1), (14, 4)])
+        actors, movies, truncated = added.path(1, 4)
+        self.assertEqual((actors, movies), ([1, 4], [14]))
+        self.assertEqual(added.costars(4), {3: 1, 1: 1})
+        # the index the change was applied to is left as it was
+        self.assertEqual(len(index.path(1, 4)[0]), 4)
+
+        removed = index.with_changes(removed=[(11, 2)])
+        self.assertEqual(removed.path(1, 4), ([], [], False))
+        self.assertEqual(removed.costars(3), {4: 1})
+
+        restored = removed.with_changes(added=[(11, 2)])
+        self.assertEqual(restored.overlay_size(), 0)
+        self.assertEqual(restored.path(1, 4)[0], [1, 2, 3, 4])
+
+        without_actor = index.with_changes(removed_actors=[2])
+        self.assertEqual(without_actor.costars(1), {})
+        self.assertEqual(without_actor.path(1, 3), ([], [], False))
+
+        without_movie = index.with_changes(removed_movies=[10])
+        self.assertEqual(without_movie.costars(1), {2: 1})
+
+    def test_costar_index_path_matches_breadth_first_search(self):
+        rng = random.Random(31)
+        for graph_number in range(50):
+            links = list({(rng.randrange(30), rng.randrange(60)) for i in range(rng.randrange(20, 120))})
+            index = CoStarIndex(links)
+            actor_ids = sorted({actor_id for movie_id, actor_id in links})
+            for i in range(10):
+                source, target = rng.choice(actor_ids), rng.choice(actor_ids)
+
+                # plain breadth first search over co-stars
+                distances = {source: 0}
+                frontier = [source]
+                while frontier and target not in distances:
+                    next_frontier = []
+                    for actor_id in frontier:
+                        for costar_id in index.costars(actor_id):
+                            if costar_id not in distances:
+                                distances[costar_id] = distances[actor_id] + 1
+                                next_frontier.append(costar_id)
+                    frontier = next_frontier
+
+                actors, movies, truncated = index.path(source, target, max_depth=100, time_limit=10)
+                self.assertFalse(truncated)
+                if target not in distances:
+                    self.assertEqual(actors, [])
+                    continue
+                self.assertEqual(len(actors) - 1, distances[target])
+                self.assertEqual((actors[0], actors[-1]), (source, target))
+                self.assertValidPath(index, actors, movies)
+
+    def test_404_get_path_to_unknown_actor(self):
+        res = self.client().get('/actors/1/path/1000', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_stats_as_casting_assistant(self):
+        res = self.client().get('/stats/movies-per-year', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sum(row['movies'] for row in data['movies_per_year']), 3)
+
+        res = self.client().get('/stats/actor-age-by-gender', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sum(row['actors'] for row in data['actor_age_by_gender']), 4)
+
+        res = self.client().get('/stats/cast-size', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['largest_casts']), 3)
+
+    def test_get_movies_with_exact_total_count(self):
+        res = self.client().get('/movies?count=exact', headers=self.headers_casting_assistant)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('X-Total-Count'), '3')
+
+    def test_400_get_actors_with_unknown_count_mode(self):
+        res = self.client().get('/actors?count=all', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], "bad request")
+
+    def test_get_movie_by_id_is_cached(self):
+        res = self.client().get('/movies/2', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['id'], 2)
+
+        res = self.client().get('/movies/2', headers=self.headers_casting_assistant)
+        data2 = json.loads(res.data)
+        self.assertEqual(res.headers.get('X-Cache'), 'HIT')
+        self.assertEqual(data2, data)
+
+    def test_get_actor_by_id_after_patch_is_not_stale(self):
+        self.client().get('/actors/1', headers=self.headers_casting_assistant)
+        res = self.client().patch('/actors/1', headers=self.headers_casting_director, json=self.new_actor)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/actors/1', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('X-Cache'), 'MISS')
+        self.assertEqual(data['actors'][0]['name'], 'Tom Hanks')
+
+    def test_get_actor_by_id_loaded_during_patch_is_not_cached(self):
+        cache = self.app.extensions['entity_cache']
+        with self.app.app_context():
+            actor = Actor.query.get(1)
+
+            def load(id):
+                # a write commits while the miss is loading the record
+                cache.invalidate([('Actor', id)])
+                return actor
+
+            cache.get(Actor, 1, load)
+        self.assertEqual(cache.stats()['stale_fills'], 1)
+
+        res = self.client().get('/actors/1', headers=self.headers_casting_assistant)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('X-Cache'), 'MISS')
+
+    def test_404_get_unknown_movie(self):
+        res = self.client().get('/movies/1000', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_post_export_job_as_casting_assistant(self):
+        res = self.client().post('/jobs', headers=self.headers_casting_assistant, json={'kind': 'export', 'entity': 'actors'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['jobs'][0]['status'], 'queued')
+
+        res = self.client().get(f'/jobs/{data["created"]}', headers=self.headers_casting_assistant)
+        data2 = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data2['jobs'][0]['id'], data['created'])
+        self.assertEqual(data2['jobs'][0]['kind'], 'export')
+
+    def test_403_post_bulk_delete_movies_job_as_casting_director(self):
+        res = self.client().post('/jobs', headers=self.headers_casting_director, json={'kind': 'bulk_delete', 'entity': 'movies', 'ids': [1]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['message']['code'], "forbidden")
+
+    def test_403_post_refresh_stats_job_as_casting_assistant(self):
+        res = self.client().post('/jobs', headers=self.headers_casting_assistant, json={'kind': 'refresh_stats'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['message']['code'], "forbidden")
+
+    def test_import_job_with_invalid_record_fails_without_retry(self):
+        records = [{'name': 'Imported', 'age': 30, 'gender': 'Male'}, {'name': None}]
+        res = self.client().post('/jobs', headers=self.headers_executive_producer,
+            json={'kind': 'import', 'entity': 'actors', 'records': records})
+        job_id = json.loads(res.data)['created']
+
+        with self.app.app_context():
+            job = claim_job()
+            while job is not None:
+                run_job(job)
+                job = claim_job()
+            imported = Actor.query.filter_by(name='Imported').count()
+
+        res = self.client().get(f'/jobs/{job_id}', headers=self.headers_executive_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['jobs'][0]['status'], 'failed')
+        self.assertEqual(data['jobs'][0]['attempts'], 1)
+        # the batch is one transaction, so the valid record is not imported either
+        self.assertEqual(imported, 0)
+
+    def test_worker_survives_a_database_error_while_failing_a_job(self):
+        res = self.client().post('/jobs', headers=self.headers_executive_producer,
+            json={'kind': 'import', 'entity': 'actors', 'records': [{'age': 30}]})
+        self.assertEqual(res.status_code, 202)
+
+        stop = threading.Event()
+        def lose_connection(*args, **kwargs):
+            stop.set()
+            raise exc.OperationalError('UPDATE jobs', {}, Exception('server closed the connection unexpectedly'))
+
+        # returns once stop is set instead of letting the error end the thread
+        with mock.patch('database.jobs.update_job', side_effect=lose_connection):
+            work(self.app, stop)
+
+    def test_get_changes_while_admission_is_saturated(self):
+        admission = self.app.extensions['admission']
+        admission.slots = threading.BoundedSemaphore(1)
+        admission.slots.acquire()
+
+        res = self.client().get('/movies', headers=self.headers_casting_assistant)
+        self.assertEqual(res.status_code, 503)
+
+        # long polls and streams wait without a database connection, they are not counted
+        res = self.client().get('/changes?timeout=0', headers=self.headers_casting_assistant)
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_health(self):
+        res = self.client().get('/health')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['database']['state'], 'closed')
+        self.assertIn('hit_ratio', data['entity_cache'])
+
+    def test_get_health_while_admission_is_saturated(self):
+        admission = self.app.extensions['admission']
+        admission.slots = threading.BoundedSemaphore(1)
+        admission.slots.acquire()
+
+        res = self.client().get('/health')
+        self.assertEqual(res.status_code, 200)
+
+    def test_queries_outside_of_requests_are_not_guarded(self):
+        guard = self.app.extensions['db_guard']
+        # every query counts as slow
+        guard.slow_query = 0
+        guard.breaker.open(time.time())
+        with self.app.app_context():
+            # a job or a migration, not failed fast by the open breaker nor counted by it
+            self.assertEqual(Movie.query.count(), 3)
+        guard.breaker.close()
+        self.assertEqual(guard.stats()['recent_queries'], 0)
+
+        self.client().get('/movies', headers=self.headers_casting_assistant)
+        self.assertGreater(guard.stats()['recent_queries'], 0)
+
+    def test_503_get_movies_with_circuit_open(self):
+        self.app.extensions['db_guard'].breaker.open(time.time())
+        res = self.client().get('/movies', headers=self.headers_casting_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['message'], "database circuit open")
+        self.assertTrue(res.headers.get('Retry-After'))
+
+        res = self.client().get('/health')
+        self.assertEqual(res.status_code, 503)
+        self.app.extensions['db_guard'].breaker.close()
+
+
+    def test_backfill_resumes_after_a_failed_batch(self):
+        with self.app.app_context():
+            conn = db.engine.connect()
+            conn.execute('CREATE TABLE backfill_test (id serial PRIMARY KEY, updates integer NOT NULL DEFAULT 0)')
+            conn.execute('INSERT INTO backfill_test (updates) SELECT 0 FROM generate_series(1, 25)')
+            locker = db.engine.connect()
+            try:
+                with conn.begin():
+                    set_timeouts(conn, lock_timeout='100ms')
+                # a transaction of the application holds a row of the second batch
+                transaction = locker.begin()
+                locker.execute('SELECT * FROM backfill_test WHERE id = 15 FOR UPDATE')
+                with Operations.context(MigrationContext.configure(conn)):
+                    with self.assertRaises(exc.OperationalError):
+                        backfill('backfill_test', 'updates = updates + 1', 'updates = 0', batch_size=10, pause=0)
+                self.assertEqual(conn.execute('SELECT count(*) FROM backfill_test WHERE updates = 1').scalar(), 10)
+
+                transaction.rollback()
+                with Operations.context(MigrationContext.configure(conn)):
+                    backfill('backfill_test', 'updates = updates + 1', 'updates = 0', batch_size=10, pause=0)
+                # every row was updated exactly once
+                self.assertEqual(conn.execute('SELECT min(updates), max(updates) FROM backfill_test').first(), (1, 1))
+            finally:
+                locker.close()
+                conn.execute('DROP TABLE backfill_test')
+                conn.close()
+
+    def test_backfill_retries_a_locked_batch(self):
+        with self.app.app_context():
+            conn = db.engine.connect()
+            conn.execute('CREATE TABLE backfill_test (id serial PRIMARY KEY, updates integer NOT NULL DEFAULT 0)')
+            conn.execute('INSERT INTO backfill_test (updates) SELECT 0 FROM generate_series(1, 25)')
+            locker = db.engine.connect()
+            try:
+                with conn.begin():
+                    set_timeouts(conn, lock_timeout='100ms')
+                transaction = locker.begin()
+                locker.execute('SELECT * FROM backfill_test WHERE id = 15 FOR UPDATE')
+                # released while the backfill waits before retrying
+                release = threading.Timer(0.3, transaction.rollback)
+                release.start()
+                with Operations.context(MigrationContext.configure(conn)):
+                    backfill('backfill_test', 'updates = updates + 1', 'updates = 0', batch_size=10, pause=0.1)
+                release.join()
+                self.assertEqual(conn.execute('SELECT min(updates), max(updates) FROM backfill_test').first(), (1, 1))
+            finally:
+                locker.close()
+                conn.execute('DROP TABLE backfill_test')
+                conn.close()
+
+    def test_create_index_concurrently_rebuilds_an_invalid_index(self):
+        with self.app.app_context():
+            conn = db.engine.connect()
+            conn.execute('CREATE TABLE index_test (id serial PRIMARY KEY, value integer)')
+            conn.execute('INSERT INTO index_test (value) VALUES (1), (1), (2)')
+            try:
+                # a concurrent build that fails leaves an invalid index behind
+                with self.assertRaises(exc.IntegrityError):
+                    conn.execution_options(isolation_level='AUTOCOMMIT').execute(
+                        'CREATE UNIQUE INDEX CONCURRENTLY ix_index_test_value ON index_test (value)')
+                valid = "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('ix_index_test_value')"
+                self.assertEqual(conn.execute(valid).scalar(), False)
+
+                conn.execute('DELETE FROM index_test WHERE id = 2')
+                with Operations.context(MigrationContext.configure(conn)):
+                    create_index_concurrently('ix_index_test_value', 'index_test', ['value'], unique=True)
+                self.assertEqual(conn.execute(valid).scalar(), True)
+                with self.assertRaises(exc.IntegrityError):
+                    conn.execute('INSERT INTO index_test (value) VALUES (2)')
+            finally:
+                conn.execute('DROP TABLE index_test')
+                conn.close()
+
+    def test_set_not_null_through_a_check_constraint(self):
+        with self.app.app_context():
+            conn = db.engine.connect()
+            conn.execute('CREATE TABLE not_null_test (id serial PRIMARY KEY, value integer)')
+            conn.execute('INSERT INTO not_null_test (value) VALUES (1), (2)')
+            try:
+                with Operations.context(MigrationContext.configure(conn)):
+                    set_not_null('not_null_test', 'value')
+                nullable = ("SELECT is_nullable FROM information_schema.columns "
+                    "WHERE table_name = 'not_null_test' AND column_name = 'value'")
+                self.assertEqual(conn.execute(nullable).scalar(), 'NO')
+                # the check constraint only served to skip the scan
+                constraints = "SELECT count(*) FROM pg_constraint WHERE conrelid = 'not_null_test'::regclass AND contype = 'c'"
+                self.assertEqual(conn.execute(constraints).scalar(), 0)
+            finally:
+                conn.execute('DROP TABLE not_null_test')
+                conn.close()
 
 # Make the tests conveniently executable
 if __name__ == "__main__":